@@ -0,0 +1,299 @@
+"""
+Offline benchmarks for the download pipeline.
+
+Runs the bot's code against benchmarks/mock_servers.py in a scratch
+directory and prints the results as JSON:
+
+    python benchmarks/run.py --output results.json
+    python benchmarks/run.py --compare results.json
+
+--compare prints the change of every metric against an earlier run.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+sys.path.insert(0, BENCH_DIR)
+
+from mock_servers import FakeBotApi, MockDeezer, mp3_bytes  # noqa: E402
+
+TOKEN = "123456:mock"
+CHAT_ID = 4242
+USER = {
+    "telegram_full_name": "Bench User",
+    "telegram_id": CHAT_ID,
+    "telegram_link": "https://t.me/bench_user",
+    "telegram_name": "@bench_user",
+    "telegram_username": "bench_user",
+}
+
+
+def summary(samples):
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "mean_ms": round(statistics.mean(samples) * 1000, 3),
+        "p50_ms": round(samples[len(samples) // 2] * 1000, 3),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - started
+
+
+def write_settings(workdir, quality):
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        json.dump({"LASTFM_API_KEY": "mock", "TELEGRAM_TOKEN": TOKEN}, f)
+    downloads = os.path.join(workdir, "downloads")
+    os.makedirs(os.path.join(workdir, ".config"))
+    with open(os.path.join(workdir, ".config", "deezpyrc"), "w") as f:
+        f.write(
+            "[DEFAULT]\n"
+            "userToken = mock\n"
+            f"quality = {quality}\n"
+            f"naming template = {downloads}/<Album Artist>/<Album>/<Track#> - <Title>\n"
+            f"playlist naming template = {downloads}/<Playlist Title>/<Track#> - <Title>\n"
+            "embed album art = True\n"
+            "download lyrics = False\n"
+        )
+
+
+def setup(workdir, deezer_server, quality):
+    """Imports the bot's modules with every endpoint pointed at the stand-ins."""
+    write_settings(workdir, quality)
+    os.environ["HOME"] = workdir
+    os.chdir(workdir)
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        import deezpy
+        import deezer_handler
+        import lastfm_handler
+        import db_handler
+        from storage import SQLiteStorage
+    finally:
+        sys.argv = argv
+
+    deezpy.apiUrl = deezer_server.url
+    deezpy.gwUrl = f"{deezer_server.url}/ajax/gw-light.php"
+    deezpy.imageUrl = f"{deezer_server.url}/images/cover"
+    deezpy.cdnUrl = deezer_server.url + "/cdn-{}"
+    lastfm_handler.API_URL = f"{deezer_server.url}/2.0/"
+    host = deezer_server.url[len("http://"):]
+    deezer_handler.DeezerHandler.client_options = {"host": host, "use_ssl": False}
+    db_handler.storage = SQLiteStorage(os.path.join(workdir, "bench.db"))
+    db_handler.create_tables()
+    return deezpy
+
+
+def bench_get_link(bot, deezer_server, tracks):
+    from deezer_handler import DeezerHandler
+    from delivery import deliver_link
+
+    links = [f"https://www.deezer.com/track/{100100 + n}" for n in range(1, tracks + 1)]
+    cold = [timed(deliver_link, bot, DeezerHandler(), CHAT_ID, link, USER) for link in links]
+    cached = [timed(deliver_link, bot, DeezerHandler(), CHAT_ID, link, USER) for link in links]
+    return {"get_link_cold": summary(cold), "get_link_cached": summary(cached)}
+
+
+def bench_album(deezpy, deezer_server):
+    album_id = 1002
+    deezpy.init()
+    served = deezer_server.served_bytes
+    elapsed = timed(deezpy.downloadDeezer, f"https://www.deezer.com/album/{album_id}")
+    megabytes = (deezer_server.served_bytes - served) / 1024 / 1024
+    tracks = deezer_server.tracks_per_album
+    return {
+        "album_download": {
+            "tracks": tracks,
+            "seconds": round(elapsed, 3),
+            "tracks_per_s": round(tracks / elapsed, 2),
+            "mb_per_s": round(megabytes / elapsed, 2),
+        }
+    }
+
+
+def bench_cdn(deezpy, deezer_server, home_latency=1.5, stall_seconds=30):
+    """ One track whose home CDN host answers late, so the hedged request
+    to another host wins, and one whose home host stalls half way, so the
+    stream resumes on another host.
+    """
+    import hashlib
+
+    def home(track_id):
+        return hashlib.md5(str(track_id).encode()).hexdigest()[0]
+
+    deezpy.init()
+    deezpy.stallTimeout = 0.5
+    slow, stalled = 100901, 100902
+    deezer_server.cdn_latency[home(slow)] = home_latency
+    hedged = timed(deezpy.downloadDeezer, f"https://www.deezer.com/track/{slow}", None, None, False)
+    deezer_server.cdn_latency.clear()
+    deezer_server.cdn_stall[home(stalled)] = (deezer_server.track_bytes // 2, stall_seconds)
+    resumed = timed(deezpy.downloadDeezer, f"https://www.deezer.com/track/{stalled}", None, None, False)
+    deezer_server.cdn_stall.clear()
+    return {
+        "cdn_hedge": {"home_latency_s": home_latency, "seconds": round(hedged, 3)},
+        "cdn_stall": {"stall_s": stall_seconds, "seconds": round(resumed, 3)},
+    }
+
+
+def bench_decrypt(deezpy, megabytes):
+    data = os.urandom(megabytes * 1024 * 1024)
+    bf_key = deezpy.getBlowfishKey("3135556")
+    started = time.perf_counter()
+    for i in range(0, len(data), 2048):
+        chunk = data[i:i + 2048]
+        if (i // 2048) % 3 == 0 and len(chunk) >= 2048:
+            deezpy.decryptChunk(chunk, bf_key)
+    elapsed = time.perf_counter() - started
+    return {"decrypt": {"mb": megabytes, "mb_per_s": round(megabytes / elapsed, 2)}}
+
+
+def bench_tags(deezpy, workdir, rounds):
+    template = os.path.join(workdir, "tags.mp3")
+    with open(template, "wb") as f:
+        f.write(mp3_bytes(1024 * 1024))
+    tags = {
+        "title": "Mock", "discnumber": 1, "tracknumber": 1, "album": "Mock Album",
+        "date": "2020-01-01", "artist": "Mock Artist", "bpm": 120,
+        "albumartist": "Mock Artist", "totaltracks": 10, "label": "Mock", "genre": "Electro",
+    }
+    samples = []
+    for n in range(rounds):
+        filename = os.path.join(workdir, f"tags-{n}.mp3")
+        shutil.copy(template, filename)
+        samples.append(timed(deezpy.writeMP3Tags, filename, dict(tags), None))
+        os.remove(filename)
+    return {"tag_write_mp3": summary(samples)}
+
+
+def bench_upload(bot_api, workdir, megabytes, rounds):
+    """ Uploads one file through the cloud style multipart upload and by
+    file:// uri to a local Bot API stand-in (BOT_API_LOCAL).
+    """
+    import delivery
+    from telegram import Bot
+    from track_store import TrackInfo
+
+    path = os.path.join(workdir, "upload.mp3")
+    with open(path, "wb") as f:
+        f.write(mp3_bytes(megabytes * 1024 * 1024))
+    song = TrackInfo("Mock", "Mock Artist", None, "Mock Artist", "Mock Album")
+    local_api = FakeBotApi(local=True).start()
+    results = {}
+    try:
+        for name, api, local in (("upload_multipart", bot_api, False), ("upload_local", local_api, True)):
+            bot = Bot(TOKEN, base_url=f"{api.url}/bot")
+            delivery.local_bot_api = local
+            samples = [timed(delivery.upload_track, bot, CHAT_ID, path, song) for _ in range(rounds)]
+            results[name] = dict(
+                summary(samples), mb=megabytes, mb_per_s=round(megabytes / statistics.mean(samples), 2)
+            )
+    finally:
+        delivery.local_bot_api = False
+        local_api.stop()
+    return results
+
+
+def bench_inline(bot, rounds):
+    from telegram import Update
+    import song_dl_bot
+
+    update_json = {
+        "update_id": 1,
+        "inline_query": {
+            "id": "1",
+            "from": {"id": CHAT_ID, "is_bot": False, "first_name": "Bench"},
+            "query": "mock",
+            "offset": "",
+        },
+    }
+    samples = []
+    for _ in range(rounds):
+        update = Update.de_json(update_json, bot)
+        context = SimpleNamespace(bot=bot, user_data={})
+        samples.append(timed(song_dl_bot.inlinequery, update, context))
+    return {"inline_query": summary(samples)}
+
+
+def compare(results, baseline_file):
+    with open(baseline_file) as f:
+        baseline = json.load(f)["results"]
+    for name, metrics in results.items():
+        for key, value in metrics.items():
+            before = baseline.get(name, {}).get(key)
+            if not isinstance(value, (int, float)) or not before:
+                continue
+            change = (value - before) / before * 100
+            print(f"{name}.{key}: {before} -> {value} ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Results JSON of an earlier run")
+    parser.add_argument("--tracks", type=int, default=10, help="Tracks per album")
+    parser.add_argument("--track-kb", type=int, default=1024, help="Size of a MP3_320 track")
+    parser.add_argument("--quality", default="2", choices=["1", "2", "3", "4"])
+    parser.add_argument("--decrypt-mb", type=int, default=16)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--upload-mb", type=int, default=20, help="Size of the upload benchmark file")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Latency of every stand-in response")
+    args = parser.parse_args()
+
+    deezer_server = MockDeezer(
+        tracks_per_album=args.tracks,
+        track_bytes=args.track_kb * 1024,
+        latency=args.latency_ms / 1000,
+    ).start()
+    bot_api = FakeBotApi(latency=args.latency_ms / 1000).start()
+    workdir = tempfile.mkdtemp(prefix="song_dl_bench_")
+    cwd = os.getcwd()
+    try:
+        deezpy = setup(workdir, deezer_server, args.quality)
+        from telegram import Bot
+
+        bot = Bot(TOKEN, base_url=f"{bot_api.url}/bot")
+        results = {}
+        results.update(bench_get_link(bot, deezer_server, args.tracks))
+        results.update(bench_album(deezpy, deezer_server))
+        results.update(bench_cdn(deezpy, deezer_server))
+        results.update(bench_decrypt(deezpy, args.decrypt_mb))
+        results.update(bench_tags(deezpy, workdir, args.rounds))
+        results.update(bench_inline(bot, args.rounds))
+        results.update(bench_upload(bot_api, workdir, args.upload_mb, min(args.rounds, 5)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        deezer_server.stop()
+        bot_api.stop()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "options": vars(args),
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
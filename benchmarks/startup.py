@@ -0,0 +1,81 @@
+"""
+Measures how long `import song_dl_bot` takes in a fresh interpreter, which is
+what a supervisor restart costs before the bot can take updates.
+
+The import runs in an empty directory, so it also fails if importing the bot
+needs config.json, deezpyrc or the database again.
+
+    python benchmarks/startup.py --runs 10 --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def run_python(code, cwd, env, extra_args=()):
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, *extra_args, "-c", f"{code}; print('ok')"],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    elapsed = time.perf_counter() - started
+    # deezpy used to exit() with status 0 when deezpyrc was missing
+    if result.returncode != 0 or "ok" not in result.stdout:
+        sys.exit(f"{code!r} failed:\n{result.stdout}{result.stderr}")
+    return elapsed, result.stderr
+
+
+def slowest_imports(stderr, top):
+    """Parses `python -X importtime` output into the `top` slowest modules."""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        if cumulative_us.strip().isdigit():
+            modules.append((int(cumulative_us), name.strip()))
+    modules.sort(reverse=True)
+    return [{"module": name, "cumulative_ms": round(us / 1000, 2)} for us, name in modules[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--top", type=int, default=10, help="Slowest imports to list")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    env = dict(os.environ, PYTHONPATH=os.path.abspath(REPO_DIR))
+    with tempfile.TemporaryDirectory() as workdir:
+        env["HOME"] = workdir
+        baseline = [run_python("pass", workdir, env)[0] for _ in range(args.runs)]
+        startup = [run_python("import song_dl_bot", workdir, env)[0] for _ in range(args.runs)]
+        _, importtime = run_python("import song_dl_bot", workdir, env, ("-X", "importtime"))
+        created = os.listdir(workdir)
+
+    report = {
+        "runs": args.runs,
+        "interpreter_ms": round(statistics.median(baseline) * 1000, 1),
+        "import_song_dl_bot_ms": round(statistics.median(startup) * 1000, 1),
+        "import_overhead_ms": round((statistics.median(startup) - statistics.median(baseline)) * 1000, 1),
+        "files_created": created,
+        "slowest_imports": slowest_imports(importtime, args.top),
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
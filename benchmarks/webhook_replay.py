@@ -0,0 +1,111 @@
+"""
+Replays recorded Update JSON against the webhook server and reports
+throughput, for measuring webhook mode offline.
+
+Post to a running bot started with WEBHOOK_URL in config.json:
+
+    python benchmarks/webhook_replay.py benchmarks/updates.jsonl \
+        --url http://127.0.0.1:8443/<WEBHOOK_PATH>
+
+or measure the server alone, with a dispatcher that only sleeps:
+
+    python benchmarks/webhook_replay.py benchmarks/updates.jsonl --local --handler-ms 50
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+class SleepingDispatcher:
+    """Stands in for the telegram Dispatcher, every update takes `delay`."""
+
+    bot = None
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.processed = 0
+        self.lock = threading.Lock()
+
+    def process_update(self, update):
+        time.sleep(self.delay)
+        with self.lock:
+            self.processed += 1
+
+
+def post(url, body):
+    request = urllib.request.Request(
+        url, data=body, headers={"Content-Type": "application/json"}
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def replay(url, updates, repeat, concurrency):
+    bodies = [json.dumps(update).encode() for update in updates] * repeat
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        statuses = Counter(pool.map(lambda body: post(url, body), bodies))
+    return statuses, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("updates", help="File with one recorded Update JSON per line")
+    parser.add_argument("--url", help="Webhook URL of a running bot")
+    parser.add_argument("--local", action="store_true", help="Start an in-process server")
+    parser.add_argument("--handler-ms", type=float, default=0, help="Handler time in --local mode")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max-queue", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    with open(args.updates) as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+
+    server = None
+    if args.local:
+        from webhook import WebhookServer
+
+        dispatcher = SleepingDispatcher(args.handler_ms / 1000)
+        server = WebhookServer(
+            dispatcher, "127.0.0.1", 0, "/bench", args.workers, args.max_queue
+        )
+        server.start()
+        url = f"http://127.0.0.1:{server.httpd.server_address[1]}/bench"
+    elif args.url:
+        url = args.url
+    else:
+        parser.error("either --url or --local is required")
+
+    started = time.perf_counter()
+    statuses, elapsed = replay(url, updates, args.repeat, args.concurrency)
+    total = sum(statuses.values())
+    result = {
+        "requests": total,
+        "statuses": dict(statuses),
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(total / elapsed, 1),
+    }
+    if server is not None:
+        server.updates.join()
+        result["processed"] = dispatcher.processed
+        result["drained_seconds"] = round(time.perf_counter() - started, 3)
+        server.stop()
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
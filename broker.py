@@ -0,0 +1,179 @@
+"""
+Job queues between the update-receiving front-end and the download workers.
+
+A job is a dict with the chat id, the deezer link and the requesting user.
+Workers lease a job with `get()` and `ack()` it once delivered. A leased job
+that isn't acked before its lease expires, e.g. because the worker died, is
+handed out again, so every job is delivered at least once.
+"""
+import json
+import sqlite3
+import time
+import uuid
+
+
+class SQLiteBroker:
+    """Queue kept in a sqlite file, for workers on the same machine."""
+
+    def __init__(self, db_file, lease_seconds=600):
+        self.lease_seconds = lease_seconds
+        self.conn = sqlite3.connect(db_file, check_same_thread=False, timeout=30)
+        with self.conn:
+            self.conn.execute(
+                """ CREATE TABLE IF NOT EXISTS jobs (
+                        id text PRIMARY KEY,
+                        payload text NOT NULL,
+                        state text NOT NULL,
+                        attempts integer NOT NULL DEFAULT 0,
+                        lease_until real NOT NULL DEFAULT 0,
+                        created real NOT NULL,
+                        result text
+                    ); """
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, created);"
+            )
+
+    def put(self, job):
+        job_id = uuid.uuid4().hex
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO jobs(id, payload, state, created) VALUES (?, ?, 'queued', ?)",
+                (job_id, json.dumps(job), time.time()),
+            )
+        return job_id
+
+    def get(self, timeout=5):
+        """Leases the oldest pending job, returns (job_id, job) or None."""
+        deadline = time.time() + timeout
+        while True:
+            now = time.time()
+            # BEGIN IMMEDIATE takes the write lock, so two workers can't
+            # lease the same row.
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    """ SELECT id, payload FROM jobs
+                        WHERE state='queued' OR (state='leased' AND lease_until<?)
+                        ORDER BY created LIMIT 1 """,
+                    (now,),
+                ).fetchone()
+                if row is not None:
+                    self.conn.execute(
+                        "UPDATE jobs SET state='leased', attempts=attempts+1, lease_until=? WHERE id=?",
+                        (now + self.lease_seconds, row[0]),
+                    )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+            if row is not None:
+                return row[0], json.loads(row[1])
+            if now >= deadline:
+                return None
+            time.sleep(0.5)
+
+    def ack(self, job_id, result=None):
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET state='done', result=? WHERE id=?",
+                (json.dumps(result), job_id),
+            )
+
+    def fail(self, job_id, error, retry=True):
+        state = "queued" if retry else "failed"
+        with self.conn:
+            self.conn.execute(
+                "UPDATE jobs SET state=?, result=? WHERE id=?",
+                (state, json.dumps({"error": str(error)}), job_id),
+            )
+
+    def attempts(self, job_id):
+        row = self.conn.execute(
+            "SELECT attempts FROM jobs WHERE id=?", (job_id,)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def depth(self):
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE state IN ('queued', 'leased')"
+        ).fetchone()[0]
+
+
+class RedisBroker:
+    """ Queue kept in redis (or anything speaking its protocol), for workers
+    spread over several machines. Uses the reliable queue pattern: a leased
+    job moves to a processing list and only leaves it on ack.
+    """
+
+    def __init__(self, url, lease_seconds=600, prefix="song_dl_bot"):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.lease_seconds = lease_seconds
+        self.queue = f"{prefix}:queue"
+        self.processing = f"{prefix}:processing"
+        self.leases = f"{prefix}:leases"
+        self.jobs = f"{prefix}:jobs"
+        self.attempts_key = f"{prefix}:attempts"
+
+    def put(self, job):
+        job_id = uuid.uuid4().hex
+        pipe = self.redis.pipeline()
+        pipe.hset(self.jobs, job_id, json.dumps(job))
+        pipe.lpush(self.queue, job_id)
+        pipe.execute()
+        return job_id
+
+    def requeue_expired(self):
+        now = time.time()
+        for job_id, lease_until in self.redis.hgetall(self.leases).items():
+            if float(lease_until) < now and self.redis.lrem(self.processing, 1, job_id):
+                self.redis.hdel(self.leases, job_id)
+                self.redis.rpush(self.queue, job_id)
+
+    def get(self, timeout=5):
+        self.requeue_expired()
+        job_id = self.redis.brpoplpush(self.queue, self.processing, timeout=timeout)
+        if job_id is None:
+            return None
+        self.redis.hset(self.leases, job_id, time.time() + self.lease_seconds)
+        self.redis.hincrby(self.attempts_key, job_id, 1)
+        payload = self.redis.hget(self.jobs, job_id)
+        return job_id.decode(), json.loads(payload)
+
+    def ack(self, job_id, result=None):
+        pipe = self.redis.pipeline()
+        pipe.lrem(self.processing, 1, job_id)
+        pipe.hdel(self.leases, job_id)
+        pipe.hdel(self.jobs, job_id)
+        pipe.hdel(self.attempts_key, job_id)
+        pipe.execute()
+
+    def fail(self, job_id, error, retry=True):
+        pipe = self.redis.pipeline()
+        pipe.lrem(self.processing, 1, job_id)
+        pipe.hdel(self.leases, job_id)
+        if retry:
+            pipe.rpush(self.queue, job_id)
+        else:
+            pipe.hdel(self.jobs, job_id)
+            pipe.hdel(self.attempts_key, job_id)
+        pipe.execute()
+
+    def attempts(self, job_id):
+        return int(self.redis.hget(self.attempts_key, job_id) or 0)
+
+    def depth(self):
+        return self.redis.llen(self.queue) + self.redis.llen(self.processing)
+
+
+def create_broker(config):
+    """ Builds the broker named by BROKER_URL in config.json, either
+    redis://host:port/db or sqlite:///path/to/jobs.db (the default).
+    """
+    url = config.get("BROKER_URL") or "sqlite:///broker.db"
+    lease_seconds = config.get("BROKER_LEASE_SECONDS", 600)
+    if url.startswith("redis://"):
+        return RedisBroker(url, lease_seconds)
+    return SQLiteBroker(url[len("sqlite:///"):], lease_seconds)
@@ -0,0 +1,50 @@
+"""
+What background downloads may spend without slowing down users.
+
+The speculator and the prefetcher only start a download while no more than
+`max_queue_depth` user updates are waiting, and stop once they downloaded
+`limit` bytes in the current period, an hour or a day.
+"""
+import threading
+import time
+
+from utils import local_now
+
+
+def this_hour():
+    return int(time.time() // 3600)
+
+
+def today():
+    return local_now().date()
+
+
+class Budget:
+    def __init__(self, queue_depth, max_queue_depth, limit, period):
+        """
+        :param queue_depth: callable returning the number of pending user updates
+        :param limit: bytes that may be downloaded per period
+        :param period: callable returning the current period, e.g. this_hour
+        """
+        self.queue_depth = queue_depth
+        self.max_queue_depth = max_queue_depth
+        self.limit = limit
+        self.period = period
+        self.lock = threading.Lock()
+        self.used = 0
+        self.current = None
+
+    def is_busy(self):
+        return self.queue_depth() > self.max_queue_depth
+
+    def left(self):
+        with self.lock:
+            period = self.period()
+            if self.current != period:
+                self.current = period
+                self.used = 0
+            return self.limit - self.used
+
+    def spend(self, size):
+        with self.lock:
+            self.used += size
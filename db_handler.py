@@ -1,128 +1,134 @@
-import sqlite3
-
-import sqlite3
-from sqlite3 import Error
-from utils import timezone_time
-from datetime import datetime
 import os
 
-def create_connection(db_file):
-    """ create a database connection to the SQLite database
-        specified by db_file
-    :param db_file: database file
-    :return: Connection object or None
-    """
-    conn = None
-    try:
-        conn = sqlite3.connect(db_file, check_same_thread=False )
-        return conn
-    except Error as e:
-        print(e)
-
-    return conn
+import metrics
+from storage import SQLiteStorage, PostgresStorage
+from utils import load_config, timezone_time
+from datetime import datetime
 
 
 database = r"sqlite3.db"
 db_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), database)
-conn = create_connection(database)
 
 
-def create_table(create_table_sql):
-    """ create a table from the create_table_sql statement
-    :param conn: Connection object
-    :param create_table_sql: a CREATE TABLE statement
-    :return:
+def create_storage():
+    """ Picks the storage backend from config.json.
+    A postgres DATABASE_URL lets several bot instances share one database,
+    otherwise the local sqlite file is used.
     """
-    with conn:
-        try:
-            c = conn.cursor()
-            c.execute(create_table_sql)
-        except Error as e:
-            print(e)
+    json_config = load_config()
+    database_url = json_config.get("DATABASE_URL")
+    if database_url and database_url.startswith("postgres"):
+        return PostgresStorage(
+            database_url, max_connections=json_config.get("DATABASE_POOL_SIZE", 10)
+        )
+    return SQLiteStorage(db_path)
+
 
+# created by init_db()
+storage = None
 
+
+def init_db():
+    """ Opens the configured storage and creates the tables.
+    Called from main(), importing this module doesn't touch the database.
+    """
+    global storage
+    storage = create_storage()
+    create_tables()
+
+
+def create_tables():
+    """Creates and migrates every table of `storage`."""
+    create_music_table()
+    alter_music_table_add_music_info()
+    create_download_table()
+    alter_music_table_add_quality()
+    alter_music_table_add_requested_quality()
+    create_quality_preference_table()
+    create_search_table()
+    create_playlist_snapshot_table()
+
+
+@metrics.timed("db")
 def create_track_record(track):
-    with conn:
-        sql = """ INSERT INTO music(telegram_file_id,deezer_link,performer,title,download_count,last_downloaded) 
-        VALUES (:telegram_file_id,:deezer_link,:performer,:title,:download_count,:last_downloaded) """
-        cur = conn.cursor()
-        cur.execute(sql, track)
-        return cur.lastrowid
+    return storage.create_track_record(track)
 
+@metrics.timed("db")
 def create_download_record(download_record):
-    with conn:
-        sql = """ INSERT INTO download(telegram_id, telegram_full_name, telegram_link, telegram_name, telegram_username, music_id) 
-        VALUES (:telegram_id, :telegram_full_name, :telegram_link, :telegram_name, :telegram_username, :music_id) """
-        cur = conn.cursor()
-        cur.execute(sql, download_record)
-        return cur.lastrowid
+    return storage.create_download_record(download_record)
 
     
+@metrics.timed("db")
 def update_track_record(track):
-    with conn:
-        sql = "UPDATE music SET download_count=download_count+1,last_downloaded=:last_downloaded, performer=:performer, title=:title WHERE deezer_link=:deezer_link "
-        cur = conn.cursor()
-        cur.execute(sql, track)
+    storage.update_track_record(track)
 
+@metrics.timed("db")
 def retreive_track_record(track):
-    with conn:
-        sql = "SELECT * from music WHERE deezer_link=:deezer_link "
-        cur = conn.cursor()
-        cur.execute(sql, track)
-        return cur.fetchone()   
-        
+    return storage.retreive_track_record(track)
+
+@metrics.timed("db")
+def retreive_track_records(track):
+    return storage.retreive_track_records(track)
+
+@metrics.timed("db")
+def retreive_track_records_by_links(links):
+    return storage.retreive_track_records_by_links(links)
+
+@metrics.timed("db")
+def retreive_quality_preference(chat_id):
+    return storage.retreive_quality_preference(chat_id)
+
+@metrics.timed("db")
+def update_quality_preference(chat_id, quality):
+    storage.update_quality_preference(chat_id, quality)
+
+@metrics.timed("db")
+def retreive_popular_tracks(limit):
+    return storage.retreive_popular_tracks(limit)
+
+@metrics.timed("db")
 def retreive_download_history():
-    with conn:
-        sql = "SELECT * from download"
-        cur = conn.cursor()
-        cur.execute(sql)
-        return cur.fetchall()
+    return storage.retreive_download_history()
+
+@metrics.timed("db_search")
+def search_tracks(query, limit):
+    return storage.search_tracks(query, limit)
+
+@metrics.timed("db")
+def retreive_playlist_snapshot(playlist_id):
+    return storage.retreive_playlist_snapshot(playlist_id)
+
+@metrics.timed("db")
+def update_playlist_snapshot(playlist_id, checksum, track_ids):
+    storage.update_playlist_snapshot(playlist_id, checksum, track_ids)
 
 def create_music_table():
-    sql_create_music_table = """ CREATE TABLE IF NOT EXISTS music (
-                                        id integer PRIMARY KEY,
-                                        telegram_file_id text NOT NULL,
-                                        deezer_link text NOT NULL,
-                                        download_count integer NOT NULL,
-                                        last_downloaded text NOT NULL
-                                    ); """
-    create_table(sql_create_music_table)
-    with conn:
-        sql = "CREATE UNIQUE INDEX IF NOT EXISTS idx_deezer_link ON music (deezer_link);"
-        cur = conn.cursor()
-        cur.execute(sql)
+    storage.create_music_table()
     
 def create_download_table():
-    sql_create_download_table = """ CREATE TABLE IF NOT EXISTS download (
-                                        id integer PRIMARY KEY,
-                                        telegram_id integer NOT NULL, 
-                                        telegram_full_name text,
-                                        telegram_link text,
-                                        telegram_name text,
-                                        telegram_username text,
-                                        music_id integer NOT NULL,
-                                        FOREIGN KEY (music_id) REFERENCES music (id)
-                                    ); """
-    create_table(sql_create_download_table)
+    storage.create_download_table()
 
 def alter_music_table_add_music_info():
-    with conn:
-        cur = conn.cursor()
-        a = cur.execute("PRAGMA table_info(music);")
-        column_names = [item[1] for item in a.fetchall()]
-        if 'title' not in column_names and 'performer' not in column_names:
-            sql = "ALTER TABLE music ADD COLUMN performer;"
-            cur.execute(sql)
-            sql = "ALTER TABLE music ADD COLUMN title;"
-            cur.execute(sql)
-            
+    storage.alter_music_table_add_music_info()
+
+def alter_music_table_add_quality():
+    storage.alter_music_table_add_quality()
+
+def alter_music_table_add_requested_quality():
+    storage.alter_music_table_add_requested_quality()
+
+def create_quality_preference_table():
+    storage.create_quality_preference_table()
 
-        
+def create_search_table():
+    storage.create_search_table()
+
+def create_playlist_snapshot_table():
+    storage.create_playlist_snapshot_table()
 
 
 def main():
-    alter_music_table_add_music_info()
-    create_download_table()
+    init_db()
     # create_music_table()
     # track = {
     #     "telegram_file_id": "jafasdfa",
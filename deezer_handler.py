@@ -1,13 +1,94 @@
-import deezer
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
 from deezpy import downloadDeezer
 import deezpy
-import configparser
-from mutagen.easyid3 import EasyID3
+import metrics
+
+
+class TimeoutSession(requests.Session):
+    """A Session with a default timeout for every request."""
+
+    def __init__(self, timeout, pool_size):
+        super().__init__()
+        self.timeout = timeout
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
 
 
 class DeezerHandler:
+    """ Every DeezerHandler of the process shares one deezer.Client, whose
+    keep-alive session is pooled across threads, and a cache of the
+    tracks, albums and artists it looked up.
+    """
+
+    # passed to deezer.Client, e.g. {"host": "127.0.0.1:8000", "use_ssl": False}
+    client_options = {}
+    # seconds before a deezer API request gives up
+    timeout = 10
+    # keep-alive connections kept open to the API
+    pool_size = 16
+    # lookups cached, and for how many seconds
+    cache_size = 1024
+    cache_ttl = 600
+
+    shared_client = None
+    lock = threading.Lock()
+    # (kind, id) -> (expiry, resource)
+    cache = OrderedDict()
+
     def __init__(self):
-        self.client = deezer.Client()
+        self.client = self.get_client()
+
+    @classmethod
+    def get_client(cls):
+        import deezer
+
+        with cls.lock:
+            if cls.shared_client is None:
+                client = deezer.Client(**cls.client_options)
+                session = TimeoutSession(cls.timeout, cls.pool_size)
+                session.headers.update(client.session.headers)
+                client.session = session
+                cls.shared_client = client
+            return cls.shared_client
+
+    def cached(self, kind, object_id, get):
+        key = (kind, str(object_id))
+        now = time.monotonic()
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None and entry[0] > now:
+                self.cache.move_to_end(key)
+                metrics.count("deezer_cache_hits")
+                return entry[1]
+        metrics.count("deezer_cache_misses")
+        resource = get(object_id)
+        with self.lock:
+            self.cache[key] = (now + self.cache_ttl, resource)
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return resource
+
+    def get_track(self, track_id):
+        return self.cached("track", track_id, self.client.get_track)
+
+    def get_album_by_id(self, album_id):
+        return self.cached("album", album_id, self.client.get_album)
+
+    def get_artist_by_id(self, artist_id):
+        return self.cached("artist", artist_id, self.client.get_artist)
 
     def get_artist(self, artist_name):
         result_artists = self.client.advanced_search(
@@ -17,10 +98,10 @@ class DeezerHandler:
         return result_artists
 
     def get_albums_of_artist(self, artist_id):
-        return self.client.get_artist(artist_id).get_albums()
+        return self.get_artist_by_id(artist_id).get_albums()
 
     def get_top_songs_of_artist(self, artist_id):
-        return self.client.get_artist(artist_id).get_top()
+        return self.get_artist_by_id(artist_id).get_top()
 
     def get_album(self, album_name):
         result_albums = self.client.advanced_search(
@@ -29,42 +110,58 @@ class DeezerHandler:
         return result_albums
 
     def get_album_songs(self, album_id):
-        return self.client.get_album(album_id).get_tracks()
+        return self.get_album_by_id(album_id).get_tracks()
 
     def get_song(self, song_name):
         result_songs = self.client.search(song_name)
         return result_songs
 
     def get_song_details(self, song_id):
-        song = self.client.get_track(song_id)
+        song = self.get_track(song_id)
         song_data = song.asdict()
         return song_data
 
     def get_full_track(self, song_id):
-        song = self.client.get_track(song_id)
+        song = self.get_track(song_id)
         return song
 
-    def download_url(self, url):
+    def download_url(self, url, quality=None, max_size=None):
+        """ Downloads `url` in the `quality` format (a name from
+        deezpy.formats) or the best one below it that fits in `max_size`
+        bytes. Returns (path, format) for a track and a list of them for
+        an album or artist, see deezpy.getTrack().
+        """
         deezpy.init()
-        items = downloadDeezer(url)
-        if "track" in url:
-            track_id = url.split("/")[-1]
-
-        if isinstance(items, list):
-            for link in items:
-                audio = EasyID3(link)
-        else:
-            audio = EasyID3(items)
-            for key, value in self.get_song_details(track_id).items():
-                if key == 'contributors':
-                    l = []
-                    for contributor in value:
-                        l.append(contributor["name"])
-                    audio['artist'] = l
-            audio.save()
-
+        # the bot only needs the stored files, not the naming template links
+        items = downloadDeezer(url, quality, max_size, templateLinks=False)
+        if "artist" in url:
+            # a list of albums, its duplicate recordings share a stored file
+            items = [item for album in items for item in album if item]
+        elif "album" in url:
+            items = [item for item in items if item]
         return items
 
+    def stored_track(self, track_id, quality=None, max_size=None):
+        """ The stored path of a deezer track in the `quality` format, or
+        None when download_url() would have to download it.
+        """
+        deezpy.loadConfig()
+        return deezpy.lookupStore(track_id, quality, max_size)
+
+    def resolve_tracks(self, track_ids):
+        """ The private API info of deezer tracks by their id as a string,
+        with one song.getListData call per hundred tracks. Tracks deezer
+        doesn't know are left out.
+        """
+        deezpy.init()
+        return deezpy.privateApiBatch(track_ids)
 
-
-d = DeezerHandler()
+    def download_track(self, track_id, info, quality=None, max_size=None):
+        """ download_url() of a track resolved by resolve_tracks(), which
+        costs no further private API call.
+        """
+        deezpy.init()
+        return deezpy.getTrack(
+            track_id, privateInfo=info, preferred=quality, maxSize=max_size,
+            templateLinks=False,
+        )
@@ -22,16 +22,23 @@ import hashlib
 import os
 import re
 import platform
+import random
+import shutil
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from functools import wraps
 
 # third party libraries:
-import mutagen
+# cryptography and mutagen are imported where they are used, importing
+# this module stays cheap for the bot until the first download.
 import requests
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MP3
 from requests.packages.urllib3.util.retry import Retry
 
+import metrics
+
 
 session = requests.Session()
 userAgent = (
@@ -50,30 +57,153 @@ httpHeaders = {
         }
 session.headers.update(httpHeaders)
 
+# endpoints, overridable to run against local stand-ins
+apiUrl = 'https://api.deezer.com'
+gwUrl = 'https://www.deezer.com/ajax/gw-light.php'
+imageUrl = 'https://e-cdns-images.dzcdn.net/images/cover'
+cdnUrl = 'https://e-cdns-proxy-{}.dzcdn.net'
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-l', "--link", dest="link", help="Downloads a given Deezer URL")
 parser.add_argument('-ll', "--linkloop", dest="linkloop", action='store_true', help="Starts a loop which continiously asks for new links")
 parser.add_argument('-b', "--batch", dest="batchfile", nargs='?', const="downloads.txt", help="Downloads links from a textfile. Default value: downloads.txt")
 parser.add_argument('-q', "--quality", dest="quality", choices=['1','2','3', '4'], help="Sets quality, overrides deezpyrc")
-args = parser.parse_args()
+# parsed in __main__, the bot imports this module with its own argv
+args = None
+
+
+# Every ARL token of deezpyrc is an account with its own session and CSRF
+# token. A download runs on the least loaded healthy account, an account
+# that gets throttled is backed off and its calls move to another one.
+accounts = []
+accountsLock = threading.Lock()
+# held by init() while it logs the accounts in
+initLock = threading.Lock()
+currentAccount = threading.local() # .account of the running download
+throttleBackoff = 30 # seconds, doubled for every throttle in a row
+maxThrottleBackoff = 900
+
+
+def newAccount(name, token):
+    accountSession = requests.Session()
+    accountSession.headers.update(httpHeaders)
+    accountSession.cookies.update({'arl': token})
+    adapter = requests.adapters.HTTPAdapter(max_retries=Retry(
+        total=3, backoff_factor=0.3, status_forcelist=(500, 502, 504),
+        method_whitelist=frozenset(['GET', 'POST'])))
+    accountSession.mount('http://', adapter)
+    accountSession.mount('https://', adapter)
+    return {'name': name, 'session': accountSession, 'CSRFToken': 'null',
+            'active': 0, 'picked': 0, 'throttles': 0, 'throttledUntil': 0}
+
+
+def pickAccount():
+    ''' The healthy account running the fewest downloads, the least
+        picked of them on a tie, or the one whose back off ends first
+        when they are all throttled.
+    '''
+    now = time.monotonic()
+    with accountsLock:
+        healthy = [account for account in accounts if account['throttledUntil'] <= now]
+        if healthy:
+            account = min(healthy, key=lambda account: (account['active'], account['picked']))
+        else:
+            account = min(accounts, key=lambda account: account['throttledUntil'])
+        account['picked'] += 1
+        return account
 
 
-def apiCall(method, json_req=False):
-    ''' Requests info from the hidden api: gw-light.php.
-        Used for loginUserToken() and privateApi().
+def onAccount(func):
+    ''' Runs a download on an account from pickAccount(), nested
+        downloads stay on the account of the outer one.
+    '''
+    @wraps(func)
+    def accountFunc(*args, **kwargs):
+        if getattr(currentAccount, 'account', None) is not None:
+            return func(*args, **kwargs)
+        account = currentAccount.account = pickAccount()
+        with accountsLock:
+            account['active'] += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            # apiCall() may have moved the download to another account
+            with accountsLock:
+                currentAccount.account['active'] -= 1
+            currentAccount.account = None
+    return accountFunc
+
+
+def throttleAccount(account):
+    with accountsLock:
+        delay = min(throttleBackoff * 2 ** account['throttles'], maxThrottleBackoff)
+        account['throttles'] += 1
+        account['throttledUntil'] = time.monotonic() + delay
+    metrics.count(f"account_{account['name']}_throttled")
+    print(f"Account {account['name']} is throttled, backing off for {delay}s")
+
+
+def accountCall(account, method, json_req):
+    ''' One gw-light.php call with account. Returns the results and
+        None, or None and 'throttled' or 'token' when the account was
+        throttled or its CSRF token expired.
     '''
     unofficialApiQueries = {
         'api_version': '1.0',
-        'api_token'  : 'null' if method == 'deezer.getUserData' else CSRFToken,
+        'api_token'  : 'null' if method == 'deezer.getUserData' else account['CSRFToken'],
         'input'      : '3',
         'method'     : method
         }
-    req = requests_retry_session().post(
-        url='https://www.deezer.com/ajax/gw-light.php',
+    metrics.count(f"account_{account['name']}_requests")
+    req = account['session'].post(
+        url=gwUrl,
         params=unofficialApiQueries,
         json=json_req
-        ).json()
-    return req['results']
+        )
+    if req.status_code in (403, 429):
+        return None, 'throttled'
+    req = req.json()
+    error = req.get('error') or {}
+    if error:
+        metrics.count(f"account_{account['name']}_errors")
+        if 'VALID_TOKEN_REQUIRED' in error:
+            return None, 'token'
+        if any('QUOTA' in key or 'RATE_LIMIT' in key for key in error):
+            return None, 'throttled'
+    return req['results'], None
+
+
+def apiCall(method, json_req=False):
+    ''' Requests info from the hidden api: gw-light.php.
+        Used for loginUserToken() and privateApi(). The call runs on the
+        account of the current download, or the least loaded one.
+    '''
+    account = getattr(currentAccount, 'account', None) or pickAccount()
+    for attempt in range(len(accounts) + 1):
+        results, problem = accountCall(account, method, json_req)
+        if problem is None:
+            account['throttles'] = 0
+            return results
+        if problem == 'token' and loginAccount(account):
+            continue
+        throttleAccount(account)
+        account = pickAccount()
+        if getattr(currentAccount, 'account', None) is not None:
+            # the rest of the download moves to the new account
+            with accountsLock:
+                currentAccount.account['active'] -= 1
+                account['active'] += 1
+            currentAccount.account = account
+    raise requests.exceptions.RetryError(f"{method}: every deezer account is throttled")
+
+
+def loginAccount(account):
+    results, problem = accountCall(account, 'deezer.getUserData', False)
+    if problem is None and results['USER']['USER_ID']:
+        # A cross-site request forgery token is needed
+        account['CSRFToken'] = results['checkForm']
+        return True
+    return False
 
 
 def loginUserToken(token):
@@ -81,23 +211,35 @@ def loginUserToken(token):
         If no USER_ID is found, False is returned and thus the
         cookie arl is wrong. Instructions for obtaining your arl
         string are in the README.md
+        The account is added to the pool.
     '''
-    cookies = {'arl': token}
-    session.cookies.update(cookies)
-    req = apiCall('deezer.getUserData')
-    if req['USER']['USER_ID']:
-        global CSRFToken # A cross-site request forgery token is needed
-        CSRFToken = req['checkForm']
-        return True
-    else:
+    account = newAccount(None, token)
+    if not loginAccount(account):
         return False
+    with accountsLock:
+        account['name'] = str(len(accounts) + 1)
+        accounts.append(account)
+    metrics.gauge(f"account_{account['name']}_active", lambda: account['active'])
+    return True
+
+
+def playlistHeader(playlistId):
+    ''' The title, nb_tracks and picture_xl of a playlist. The official
+        API's playlist object carries its tracks too, the private API's
+        playlist.getData leaves them out.
+    '''
+    req = apiCall('playlist.getData', {'playlist_id': playlistId, 'lang': 'en'})
+    imagesUrl = imageUrl.rsplit('/', 1)[0]
+    return {'title': req['TITLE'], 'nb_tracks': int(req['NB_SONG']),
+            'picture_xl': f"{imagesUrl}/playlist/{req['PLAYLIST_PICTURE']}/1000x1000-000000-80-0-0.jpg"}
 
 
 def privateApi(songId):
     ''' Get the required info from the unofficial API
         to decrypt the files.
     '''
-    req = apiCall('deezer.pageTrack', {'SNG_ID': songId})
+    with metrics.timer('privateApi'):
+        req = apiCall('deezer.pageTrack', {'SNG_ID': songId})
     privateInfo = req['DATA']
     if "FALLBACK" in privateInfo:
         # Some songs in a playlist have other IDs than the same song
@@ -109,6 +251,29 @@ def privateApi(songId):
     return privateInfo
 
 
+def privateApiBatch(songIds, batchSize=100):
+    ''' Like privateApi(), but for many songs with one song.getListData
+        call per batchSize songs. Returns a dict of SNG_ID -> info.
+        FALLBACK ids are resolved in a second batched pass.
+    '''
+    songIds = [str(songId) for songId in songIds]
+    infos = {}
+    for start in range(0, len(songIds), batchSize):
+        batch = songIds[start:start+batchSize]
+        with metrics.timer('privateApiBatch'):
+            req = apiCall('song.getListData', {'sng_ids': batch})
+        for info in req['data']:
+            infos[str(info['SNG_ID'])] = info
+    fallbacks = {songId: str(info['FALLBACK']['SNG_ID'])
+                 for songId, info in infos.items() if 'FALLBACK' in info}
+    if fallbacks:
+        resolved = privateApiBatch(list(set(fallbacks.values())), batchSize)
+        for songId, fallbackId in fallbacks.items():
+            if fallbackId in resolved:
+                infos[songId] = resolved[fallbackId]
+    return infos
+
+
 # https://www.peterbe.com/plog/best-practice-with-retries-with-requests
 def requests_retry_session(retries=3, backoff_factor=0.3,
                            status_forcelist=(500, 502, 504)):
@@ -128,38 +293,115 @@ def requests_retry_session(retries=3, backoff_factor=0.3,
 
 def getJSON(mediaType, mediaId, subtype=""):
     ''' Official API. This function is used to download the ID3 tags.
-        Subtype can be 'albums' or 'tracks'.
+        Subtype can be 'albums' or 'tracks', use getJSONPages() for
+        those when the list can be long.
     '''
-    url = f'https://api.deezer.com/{mediaType}/{mediaId}/{subtype}?limit=-1'
-    return requests_retry_session().get(url).json()
+    url = f'{apiUrl}/{mediaType}/{mediaId}/{subtype}?limit=-1'
+    return getURL(url)
+
+
+def getURL(url):
+    with metrics.timer('getJSON'):
+        return requests_retry_session().get(url).json()
+
+
+# items per official API page, and the pages getJSONPages() reads ahead
+pageSize = 100
+
+
+def getJSONPages(mediaType, mediaId, subtype):
+    ''' Official API list (subtype 'albums' or 'tracks') as a generator
+        of pages of pageSize items, following the 'next' links. The next
+        page is fetched while the caller works on the current one, so a
+        playlist of thousands of tracks is never held in memory at once.
+    '''
+    url = f'{apiUrl}/{mediaType}/{mediaId}/{subtype}?index=0&limit={pageSize}'
+    page = sidePool().submit(getURL, url)
+    while page is not None:
+        data = page.result()
+        nextUrl = data.get('next')
+        page = sidePool().submit(getURL, nextUrl) if nextUrl else None
+        yield data.get('data', [])
+
+
+# Lyrics and cover art are fetched on these threads while the audio is
+# streaming, see sideFetch(). Futures are kept per SNG_ID and
+# (ALB_PICTURE, size) so an album only fetches its cover once.
+sideFetches = None
+sideLock = threading.Lock()
+lyricsFutures = {}
+coverFutures = {}
+maxCachedLyrics = 256
+maxCachedCovers = 16 # 1500px pngs are a few MB each
+
+
+def sidePool():
+    global sideFetches
+    with sideLock:
+        if sideFetches is None:
+            sideFetches = ThreadPoolExecutor(max_workers=4,
+                                             thread_name_prefix='deezpy-side')
+        return sideFetches
+
+
+def sideFetch(cache, key, limit, func, *args):
+    ''' Starts func(*args) on the side fetch threads, unless a fetch
+        for key is already in cache, and returns its Future. Failed
+        fetches are dropped from the cache so the next call retries.
+    '''
+    pool = sidePool()
+    with sideLock:
+        if key in cache:
+            return cache[key]
+        future = cache[key] = pool.submit(func, *args)
+        while len(cache) > limit:
+            del cache[next(iter(cache))]
+
+    def forgetFailed(future):
+        if future.exception() is not None:
+            with sideLock:
+                if cache.get(key) is future:
+                    del cache[key]
+    future.add_done_callback(forgetFailed)
+    return future
+
+
+def fetchCoverArt(artID, size):
+    ''' Downloads the coverart/playlist image from the official API. '''
+    url = f'{imageUrl}/{artID}/{size}x{size}.png'
+    with metrics.timer('cover_art'):
+        return requests_retry_session().get(url).content
+
+
+def coverArt(artID, size):
+    ''' Future of fetchCoverArt(artID, size). '''
+    return sideFetch(coverFutures, (artID, size), maxCachedCovers,
+                     fetchCoverArt, artID, size)
 
 
 def getCoverArt(artID, filename, size):
-    ''' Retrieves the coverart/playlist image from the official API,
-        downloads it to the download folder and returns it.
+    ''' Saves the coverart/playlist image from the official API as
+        cover.png in the folder of filename, a naming template path.
     '''
-    url = f'https://e-cdns-images.dzcdn.net/images/cover/{artID}/{size}x{size}.png'
     path = os.path.dirname(filename)
     imageFile = f'{path}/cover.png'
+    if os.path.isfile(imageFile):
+        return
+    image = coverArt(artID, size).result()
     if not os.path.isdir(path):
         os.makedirs(path)
-    if os.path.isfile(imageFile):
-        with open(imageFile, 'rb') as f:
-            return f.read()
-    else:
-        with open(imageFile, 'wb') as f:
-            r = requests_retry_session().get(url)
-            f.write(r.content)
-            return r.content
+    with open(imageFile, 'wb') as f:
+        f.write(image)
 
 
-def getLyrics(trackId, filename):
+def fetchLyrics(trackId):
     ''' Recieves (timestamped) lyrics from the unofficial api
-        and converts them to a conventional .lrc file.
-        If only the unsynced lyrics are found, these are written
-        to a .txt file.
+        and converts them to a conventional .lrc file content.
+        If only the unsynced lyrics are found, these are returned
+        for a .txt file. Returns (ext, lyrics) or None.
     '''
-    req = apiCall('song.getLyrics', {'sng_id': trackId})
+    with metrics.timer('lyrics'):
+        req = apiCall('song.getLyrics', {'sng_id': trackId})
     if 'LYRICS_SYNC_JSON' in req: # synced lyrics
         rawLyrics = req['LYRICS_SYNC_JSON']
         ext = '.lrc'
@@ -178,10 +420,35 @@ def getLyrics(trackId, filename):
         lyrics = req['LYRICS_TEXT'].splitlines(True) # True keeps the \n
         ext = '.txt'
     else:
+        return None
+    return ext, ''.join(lyrics)
+
+
+def lyricsOf(trackId):
+    ''' Future of fetchLyrics(trackId). '''
+    return sideFetch(lyricsFutures, str(trackId), maxCachedLyrics,
+                     fetchLyrics, trackId)
+
+
+def writeLyrics(filename, fetched):
+    ''' Writes the result of fetchLyrics() next to the track. The
+        file is replaced as a whole, so re-runs don't repeat lines.
+    '''
+    if fetched is None:
         return False
-    with open(f'{filename}{ext}', 'a') as f:
-        for lyricLine in lyrics:
-            f.write(lyricLine)
+    ext, lyrics = fetched
+    tempFile = f'{filename}{ext}.part'
+    with open(tempFile, 'w') as f:
+        f.write(lyrics)
+    os.replace(tempFile, f'{filename}{ext}')
+    return True
+
+
+def getLyrics(trackId, filename):
+    ''' Fetches the lyrics of trackId and writes them to
+        filename.lrc or filename.txt.
+    '''
+    return writeLyrics(filename, lyricsOf(trackId).result())
 
 
 def getTags(trackInfo, albInfo, playlist):
@@ -197,7 +464,8 @@ def getTags(trackInfo, albInfo, playlist):
         'tracknumber' : trackInfo['track_position'],
         'album'       : trackInfo['album']['title'],
         'date'        : trackInfo['album']['release_date'],
-        'artist'      : trackInfo['artist']['name'],
+        'artist'      : [contributor['name'] for contributor in
+                         trackInfo.get('contributors', [])] or trackInfo['artist']['name'],
         'bpm'         : trackInfo['bpm'],
         'albumartist' : albInfo['artist']['name'],
         'totaltracks' : albInfo['nb_tracks'],
@@ -205,18 +473,21 @@ def getTags(trackInfo, albInfo, playlist):
         'genre'       : genre
         }
     if playlist: # edit some info to get playlist suitable tags
-        tags['title'] = 'Various Artists'
+        tags['albumartist'] = 'Various Artists'
         tags['totaltracks'] = playlist[0]['nb_tracks']
         tags['album'] = playlist[0]['title']
         tags['tracknumber'] = playlist[1]
-        tags['disknumber'] = ''
+        tags['discnumber'] = ''
         tags['date'] = ''
         trackInfo['album']['cover_xl'] = playlist[0]['picture_xl']
     return tags
 
 
+@metrics.tagged('writeFlacTags')
 def writeFlacTags(filename, tags, imageUrl):
     ''' Function to write tags to the file, be it FLAC or MP3.'''
+    import mutagen
+    import mutagen.flac
     # Download and load the image
     # cover_xl returns 1000px jpg link,
     # but 1500px png is available, so we modify url
@@ -229,7 +500,7 @@ def writeFlacTags(filename, tags, imageUrl):
     handle.delete()  # delete pre-existing tags and pics
     handle.clear_pictures()
     if imageUrl:
-        image = getCoverArt(imageUrl, filename, 1500) # TODO: write to temp folder?
+        image = coverArt(imageUrl, 1500).result()
         pic = mutagen.flac.Picture()
         pic.encoding=3
         pic.mime='image/png'
@@ -238,12 +509,16 @@ def writeFlacTags(filename, tags, imageUrl):
         handle.add_picture(pic)
 
     for key, val in tags.items():
-        handle[key] = str(val)
+        handle[key] = [str(v) for v in val] if isinstance(val, list) else str(val)
     handle.save()
     return True
 
 
+@metrics.tagged('writeMP3Tags')
 def writeMP3Tags(filename, tags, imageUrl):
+    import mutagen.id3
+    from mutagen.easyid3 import EasyID3
+    from mutagen.mp3 import MP3
     handle = MP3(filename, ID3=EasyID3)
     handle.delete()
     # label is not supported by easyID3, so we add it
@@ -253,10 +528,10 @@ def writeMP3Tags(filename, tags, imageUrl):
     del tags['totaltracks']
 
     for key, val in tags.items():
-        handle[key] = str(val)
+        handle[key] = [str(v) for v in val] if isinstance(val, list) else str(val)
     handle.save()
     if imageUrl:
-        image = getCoverArt(imageUrl, filename, 1500) # TODO: write to temp folder?
+        image = coverArt(imageUrl, 1500).result()
         handle= MP3(filename)
         handle["APIC"] = mutagen.id3.APIC(
                                         encoding=3, # 3 is for utf-8
@@ -318,12 +593,15 @@ def nameFile(trackInfo, albInfo, playlistInfo=False):
     return filename
 
 
-def getTrackDownloadUrl(privateInfo, quality):
+def getTrackDownloadUrl(privateInfo, quality, host=None):
     ''' Calculates the deezer download URL from
         a given MD5_ORIGIN, SNG_ID and MEDIA_VERSION.
         If a user is not logged in, no MD5_ORIGIN is
-        found in privateInfo.
+        found in privateInfo. host is one of cdnHosts,
+        MD5_ORIGIN's first char by default.
     '''
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
     # this specific unicode char is needed
     char = b'\xa4'.decode('unicode_escape')
     step1 = char.join((privateInfo['MD5_ORIGIN'],
@@ -337,19 +615,145 @@ def getTrackDownloadUrl(privateInfo, quality):
                     modes.ECB(), default_backend())
     encryptor = cipher.encryptor()
     step3 = encryptor.update(bytes([ord(x) for x in step2])).hex()
-    cdn = privateInfo['MD5_ORIGIN'][0]
-    decryptedUrl = f'https://e-cdns-proxy-{cdn}.dzcdn.net/mobile/1/{step3}'
+    cdn = host or privateInfo['MD5_ORIGIN'][0]
+    decryptedUrl = f'{cdnUrl.format(cdn)}/mobile/1/{step3}'
     return decryptedUrl
 
 
-def resumeDownload(url, filesize):
-    resume_header = {'Range': 'bytes=%d-' % filesize}
-    req = requests_retry_session().get(url,
-                                       headers=resume_header,
-                                       stream=True)
+# Every e-cdns-proxy host serves every track, MD5_ORIGIN's first char only
+# picks the home host. The hosts are ranked by the throughput we measured,
+# a first byte later than usual is hedged with a request to the next host
+# and a stream that stalls moves to another host with a Range request.
+cdnHosts = '0123456789abcdef'
+hedgeQuantile = 0.95 # of the recent first byte times, the hedge deadline
+hedgeMinDelay = 0.2
+hedgeDefaultDelay = 1.0 # until enough first byte times are known
+stallTimeout = 5 # seconds without a byte before switching hosts
+stallPenalty = 60 # seconds a stalled host is ranked last
+maxCdnSwitches = 3
+cdnLock = threading.Lock()
+cdnTtfb = {} # host -> recent first byte times, None -> of all hosts
+cdnThroughput = {} # host -> moving average of bytes per second
+cdnStalledUntil = {}
+cdnPool = None
+# without retries: a failed host is left for the next one, retrying it
+# would only eat the hedge deadline
+cdnSession = requests.Session()
+cdnSession.headers.update(httpHeaders)
+
+
+def recordCdnTtfb(host, seconds):
+    with cdnLock:
+        for key in (host, None):
+            cdnTtfb.setdefault(key, deque(maxlen=64)).append(seconds)
+    metrics.observe('cdn_ttfb', seconds)
+
+
+def recordCdnThroughput(host, received, seconds):
+    if not received or seconds <= 0:
+        return
+    with cdnLock:
+        rate = received / seconds
+        previous = cdnThroughput.get(host)
+        cdnThroughput[host] = rate if previous is None else 0.7 * previous + 0.3 * rate
+
+
+def recordCdnStall(host):
+    with cdnLock:
+        cdnStalledUntil[host] = time.monotonic() + stallPenalty
+    metrics.count('cdn_stalls')
+
+
+def rankCdnHosts(home):
+    ''' All cdnHosts, best first: the home host, then the measured hosts
+        by throughput, then the others in random order. Hosts that stalled
+        lately go last.
+    '''
+    now = time.monotonic()
+    with cdnLock:
+        measured = sorted((host for host in cdnThroughput if host != home),
+                          key=lambda host: -cdnThroughput[host])
+        stalled = {host for host, until in cdnStalledUntil.items() if until > now}
+    unmeasured = [host for host in cdnHosts if host != home and host not in measured]
+    random.shuffle(unmeasured)
+    ranked = [home] + measured + unmeasured
+    return [host for host in ranked if host not in stalled] + \
+           [host for host in ranked if host in stalled]
+
+
+def cdnUrls(privateInfo, quality):
+    ''' (host, url) pairs of the track on every CDN host, best first. '''
+    return [(host, getTrackDownloadUrl(privateInfo, quality, host))
+            for host in rankCdnHosts(privateInfo['MD5_ORIGIN'][0])]
+
+
+def hedgeDelay(host):
+    ''' Seconds to wait for host's first byte before asking another host. '''
+    with cdnLock:
+        samples = sorted(cdnTtfb.get(host) or cdnTtfb.get(None) or ())
+    if len(samples) < 8:
+        return hedgeDefaultDelay
+    return max(hedgeMinDelay, samples[min(len(samples)-1, int(len(samples)*hedgeQuantile))])
+
+
+def cdnRequest(host, url, offset):
+    headers = {'Range': f'bytes={offset}-'} if offset else None
+    started = time.perf_counter()
+    req = cdnSession.get(url, headers=headers, stream=True, timeout=stallTimeout)
+    # a host that ignores the Range header would send the file from
+    # its first byte, appending that would corrupt the download
+    if req.status_code != (206 if offset else 200):
+        req.close()
+        raise requests.exceptions.HTTPError(f'{host}: HTTP {req.status_code}')
+    recordCdnTtfb(host, time.perf_counter() - started)
     return req
 
 
+def closeLoser(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
+
+
+def openCdnStream(urls, offset=0):
+    ''' GETs the first of urls, (host, url) pairs, from byte offset.
+        When its first byte takes longer than hedgeDelay() the next
+        host is asked as well, the first response wins and the other
+        one is closed. Failed hosts fail over to the next one.
+        Returns (host, response).
+    '''
+    global cdnPool
+    with cdnLock:
+        if cdnPool is None:
+            cdnPool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='deezpy-cdn')
+    urls = list(urls)
+    pending = {}
+    error = None
+    hedge = True
+    while True:
+        if urls and (hedge or not pending):
+            host, url = urls.pop(0)
+            if pending:
+                metrics.count('cdn_hedges')
+            pending[cdnPool.submit(cdnRequest, host, url, offset)] = host
+        if not pending:
+            raise error
+        timeout = hedgeDelay(next(iter(pending.values()))) if urls and len(pending) < 2 else None
+        done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        hedge = not done
+        for future in done:
+            host = pending.pop(future)
+            try:
+                req = future.result()
+            except Exception as e:
+                print(f"CDN host {host} failed: {e}")
+                error = e
+                continue
+            for loser in pending:
+                if not loser.cancel():
+                    loser.add_done_callback(closeLoser)
+            return host, req
+
+
 def deezerTypeId(url):
     ''' Checks if url is valid and then returns type ID.'''
     return url.split('/')[-2:]
@@ -368,6 +772,8 @@ def getBlowfishKey(trackId):
 
 def decryptChunk(chunk, bfKey):
     ''' Decrypt a given encrypted chunk with a blowfish key. '''
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
     cipher = Cipher(algorithms.Blowfish(bfKey),
                     modes.CBC(bytes([i for i in range(8)])),
                     default_backend())
@@ -376,8 +782,13 @@ def decryptChunk(chunk, bfKey):
     return decChunk
 
 
-def downloadTrack(filename, ext, url, bfKey):
-    ''' Download and decrypts a track. Resumes download for tmp files.'''
+@metrics.tagged('downloadTrack')
+def downloadTrack(filename, ext, urls, bfKey):
+    ''' Download and decrypts a track. Resumes download for tmp files.
+        urls is a list of (host, url) pairs, see cdnUrls(), or one url.
+    '''
+    if isinstance(urls, str):
+        urls = [(None, urls)]
     tmpFile = f'{filename}.tmp'
     realFile = f'{filename}{ext}'
     if os.path.isfile(tmpFile):
@@ -385,15 +796,14 @@ def downloadTrack(filename, ext, url, bfKey):
         filesize = os.stat(tmpFile).st_size  # size downloaded file
         # reduce filesize to a multiple of 2048 for seamless decryption
         filesize = filesize - (filesize % 2048)
-        i = filesize/2048
-        req = resumeDownload(url, filesize)
+        host, req = openCdnStream(urls, filesize)
     else:
         print(f"Downloading: {realFile}... ", end='', flush=True)
         filesize = 0
-        i = 0
-        req = requests_retry_session().get(url, stream=True)
+        host, req = openCdnStream(urls)
         if req.headers['Content-length'] == '0':
             print("Empty file, skipping...\n", end='')
+            req.close()
             return False
         # make dirs if they do not exist yet
         fileDir = os.path.dirname(realFile)
@@ -401,32 +811,94 @@ def downloadTrack(filename, ext, url, bfKey):
             os.makedirs(fileDir)
 
     # Decrypt content and write to file
+    # timings are summed locally and recorded once per track
+    started = time.perf_counter()
+    decryptTime = 0.0
+    received = 0
+    switches = 0
+    i = filesize // 2048
     with open(tmpFile, 'ab') as fd:
-        fd.seek(filesize)  # jump to end of the file in order to append to it
-        # Only every third 2048 byte block is encrypted.
-        for chunk in req.iter_content(2048):
-            if i % 3 == 0 and len(chunk) >= 2048:
-                chunk = decryptChunk(chunk, bfKey)
-            fd.write(chunk)
-            i += 1
+        fd.truncate(filesize)  # drop a partial block left by an earlier run
+        while True:
+            streamHost = host
+            streamStarted = time.perf_counter()
+            streamReceived = 0
+            try:
+                # Only every third 2048 byte block is encrypted.
+                for chunk in req.iter_content(2048):
+                    received += len(chunk)
+                    streamReceived += len(chunk)
+                    if i % 3 == 0 and len(chunk) >= 2048:
+                        decryptStarted = time.perf_counter()
+                        chunk = decryptChunk(chunk, bfKey)
+                        decryptTime += time.perf_counter() - decryptStarted
+                    fd.write(chunk)
+                    filesize += len(chunk)
+                    i += 1
+                break
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError) as error:
+                # iter_content only yields whole blocks, so filesize is
+                # still a multiple of 2048 and the next host resumes there
+                req.close()
+                recordCdnStall(host)
+                switches += 1
+                if switches > maxCdnSwitches:
+                    raise
+                print(f"CDN host {host} stalled ({error}), resuming elsewhere... ",
+                      end='', flush=True)
+                urls = [url for url in urls if url[0] != host] + \
+                       [url for url in urls if url[0] == host]
+                host, req = openCdnStream(urls, filesize)
+            finally:
+                recordCdnThroughput(streamHost, streamReceived,
+                                    time.perf_counter() - streamStarted)
     os.rename(tmpFile, realFile)
+    metrics.observe('cdn_download', time.perf_counter() - started - decryptTime)
+    metrics.observe('decrypt', decryptTime)
+    metrics.count('cdn_bytes', received)
+    account = getattr(currentAccount, 'account', None)
+    if account is not None:
+        metrics.count(f"account_{account['name']}_bytes", received)
     return True
 
 
-def getQuality(privateInfo):
+# quality setting n (1-4) is index n-1 of these lists
+filesizes = ['FILESIZE_FLAC', 'FILESIZE_MP3_320', 'FILESIZE_MP3_256', 'FILESIZE_MP3_128'] #, 'FILESIZE_MP3_64', 'FILESIZE_AAC_64'] TODO add MP3_64 and AAC_64
+qualities = ['9','3','5','1'] # filesizes[i] corresponds with qualities[i]
+formats = [size[9:] for size in filesizes] # 'FLAC', 'MP3_320', ...
+
+
+def preferredQuality():
+    ''' Index of the preferred quality in args or deezpyrc. '''
+    if args and args.quality:
+        return int(args.quality)-1
+    loadConfig()
+    return int(config.get('DEFAULT','quality')) - 1
+
+
+def getQuality(privateInfo, preferred=None, maxSize=None):
+    ''' Picks the preferred format (a name from formats, default from
+        args or deezpyrc) or the best one below it whose FILESIZE_*
+        fits in maxSize bytes, so we never download a file the sink
+        would refuse.
+    '''
     # if the preferred quality is not available, get the one below etc.
-    if args.quality:
-        qualitySetting = int(args.quality)-1
+    if preferred:
+        qualitySetting = formats.index(preferred)
     else:
-        qualitySetting = int(config.get('DEFAULT','quality')) - 1
-
-    filesize = ['FILESIZE_FLAC', 'FILESIZE_MP3_320', 'FILESIZE_MP3_256', 'FILESIZE_MP3_128'] #, 'FILESIZE_MP3_64', 'FILESIZE_AAC_64'] TODO add MP3_64 and AAC_64
-    qualities = ['9','3','5','1'] # filesize[i] corresponds with qualities[i]
-    for i in range(qualitySetting, len(qualities)-1):
-        if int(privateInfo[filesize[i]]) != 0:
-            if not i == qualitySetting:
-                print(f"This song is not available in the preferred quality {filesize[qualitySetting][9:]}, downloading in {filesize[i][9:]}")
-            return qualities[i]
+        qualitySetting = preferredQuality()
+
+    for i in range(qualitySetting, len(qualities)):
+        size = int(privateInfo[filesizes[i]])
+        if size == 0:
+            continue
+        if maxSize and size > maxSize:
+            print(f"{formats[i]} is {size} bytes, over the {maxSize} bytes limit")
+            continue
+        if not i == qualitySetting:
+            print(f"This song is not available in the preferred quality {formats[qualitySetting]}, downloading in {formats[i]}")
+        return qualities[i]
     return None
 
 
@@ -437,54 +909,251 @@ def getExt(quality):
         return '.mp3'
 
 
-def getTrack(trackId, playlist=False):
+def storeFolder():
+    ''' Folder of the content-addressed store, 'store folder' in
+        deezpyrc. Every track is kept there once per quality, the
+        naming template paths are links to it.
+    '''
+    default = os.path.join(os.path.expanduser('~'), '.cache', 'deezpy', 'store')
+    return config.get('DEFAULT', 'store folder', fallback=default)
+
+
+def storePath(sngId, quality):
+    ''' Path of SNG_ID in quality, without the extension. '''
+    sngId = str(sngId)
+    return os.path.join(storeFolder(), sngId[-2:], f'{sngId}-{formats[qualities.index(quality)]}')
+
+
+def storedTrack(sngId, quality, maxSize=None):
+    ''' Path of the stored file of SNG_ID in quality, or None when it
+        isn't stored or is bigger than maxSize.
+    '''
+    path = f'{storePath(sngId, quality)}{getExt(quality)}'
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return None
+    if maxSize and size > maxSize:
+        return None
+    return path
+
+
+def lookupStore(trackId, preferred=None, maxSize=None):
+    ''' Stored path of trackId in the preferred format, or None. '''
+    quality = qualities[formats.index(preferred or formats[preferredQuality()])]
+    return storedTrack(trackId, quality, maxSize)
+
+
+def linkStored(stored, filename):
+    ''' Makes filename a hardlink to the stored file, or a symlink when
+        the store is on another filesystem. An existing filename is
+        left alone.
+    '''
+    if os.path.lexists(filename):
+        return filename
+    fileDir = os.path.dirname(filename)
+    if fileDir and not os.path.isdir(fileDir):
+        os.makedirs(fileDir)
+    try:
+        os.link(stored, filename)
+    except OSError:
+        os.symlink(os.path.abspath(stored), filename)
+    return filename
+
+
+def linkLyrics(stored, filename):
+    ''' Links the lyrics stored next to a stored track, if any, to
+        filename.lrc or filename.txt.
+    '''
+    base = os.path.splitext(stored)[0]
+    for ext in ('.lrc', '.txt'):
+        if os.path.isfile(f'{base}{ext}') and base != filename:
+            linkStored(f'{base}{ext}', f'{filename}{ext}')
+
+
+def copyStored(stored, filename, tags, imageUrl):
+    ''' Makes filename a copy of the stored file with its own tags,
+        for routes that tag a track differently from its album. An
+        existing filename is left alone.
+    '''
+    if os.path.lexists(filename):
+        return filename
+    fileDir = os.path.dirname(filename)
+    if fileDir and not os.path.isdir(fileDir):
+        os.makedirs(fileDir)
+    shutil.copyfile(stored, f'{filename}.part')
+    if filename.endswith('.flac'):
+        writeFlacTags(f'{filename}.part', tags, imageUrl)
+    else:
+        writeMP3Tags(f'{filename}.part', tags, imageUrl)
+    os.replace(f'{filename}.part', filename)
+    return filename
+
+
+# (SNG_ID, quality) -> [lock, waiters] of the downloads in flight
+fetchLocks = {}
+fetchLocksLock = threading.Lock()
+
+
+@contextmanager
+def fetching(sngId, quality):
+    ''' Holds the lock of SNG_ID in quality, so one thread at a time
+        downloads it into the store.
+    '''
+    key = (str(sngId), quality)
+    with fetchLocksLock:
+        entry = fetchLocks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with fetchLocksLock:
+            entry[1] -= 1
+            if not entry[1]:
+                del fetchLocks[key]
+
+
+def fetchTrack(trackInfo, albInfo, privateInfo, quality):
+    ''' Downloads and tags a track into the store and returns its path,
+        or False. A second caller for the same SNG_ID and quality waits
+        for the first one and gets its file. The stored file only
+        appears once it is tagged, with the tags of its album whatever
+        route downloaded it first.
+    '''
+    with fetching(privateInfo['SNG_ID'], quality):
+        stored = storedTrack(privateInfo['SNG_ID'], quality)
+        if stored:
+            metrics.count('store_hits')
+            return stored
+        metrics.count('store_misses')
+        # start fetching cover art and lyrics now, they arrive
+        # while the audio is downloading
+        if config.getboolean('DEFAULT', 'embed album art'):
+            imageUrl = privateInfo['ALB_PICTURE']
+            coverArt(imageUrl, 1500)
+        else:
+            imageUrl = None
+        if config.getboolean('DEFAULT', 'download lyrics'):
+            lyrics = lyricsOf(privateInfo['SNG_ID'])
+        else:
+            lyrics = None
+        ext = getExt(quality)
+        storeFile = storePath(privateInfo['SNG_ID'], quality)
+        bfKey = getBlowfishKey(privateInfo['SNG_ID'])
+        if not downloadTrack(f'{storeFile}.part', ext, cdnUrls(privateInfo, quality), bfKey):
+            return False
+        partFile = f'{storeFile}.part{ext}'
+        tags = getTags(trackInfo, albInfo, False)
+
+        with metrics.timer('tag_write'):
+            if quality == '9':
+                writeFlacTags(partFile, tags, imageUrl)
+            else:
+                writeMP3Tags(partFile, tags, imageUrl)
+        stored = f'{storeFile}{ext}'
+        os.replace(partFile, stored)
+
+        # the lyrics are stored next to the track, getTrack() links
+        # them to the naming template path
+        if lyrics is not None:
+            try:
+                writeLyrics(storeFile, lyrics.result())
+            except Exception as error:
+                print(f"Could not get the lyrics: {error}")
+        return stored
+
+
+@metrics.tagged('getTrack')
+def getTrack(trackId, playlist=False, privateInfo=None, albInfo=None,
+             preferred=None, maxSize=None, templateLinks=True):
     ''' Calls the necessary functions to download and tag the tracks.
         Playlist must be a tuple of (playlistInfo, playlistTrack).
+        privateInfo and albInfo can be passed in when they were
+        already fetched for a whole album or playlist.
+        preferred and maxSize are passed to getQuality().
+        Files are downloaded to the store (see storePath()) and linked
+        to the naming template path. Without templateLinks the stored
+        path is returned, and a stored track costs no request at all.
+        Returns (path, format), format being the name from formats that
+        was chosen, e.g. 'FLAC', or False.
     '''
+    # look in the store before asking deezer for anything
+    stored = lookupStore(trackId, preferred, maxSize)
+    if stored and not templateLinks:
+        metrics.count('store_hits')
+        return stored, preferred or formats[preferredQuality()]
+
     trackInfo = getJSON('track', trackId)
-    albInfo = getJSON('album', trackInfo['album']['id'])
+    if albInfo is None:
+        albInfo = getJSON('album', trackInfo['album']['id'])
     #if not trackInfo['readable']:
     #    print(f"Song {trackInfo['title']} not available, skipping...")
     #    return False
-    privateInfo = privateApi(trackId)
-    quality = getQuality(privateInfo)
-    if not quality:
-        print((f"Song {trackInfo['title']} not available, skipping..."
-               "\nMaybe try with a higher quality setting?"))
-        return False
+    if stored:
+        quality = qualities[formats.index(preferred or formats[preferredQuality()])]
+    else:
+        if privateInfo is None:
+            privateInfo = privateApi(trackId)
+        quality = getQuality(privateInfo, preferred, maxSize)
+        if not quality:
+            print((f"Song {trackInfo['title']} not available, skipping..."
+                   "\nMaybe try with a higher quality setting?"))
+            return False
+        # FALLBACK tracks are stored under the SNG_ID they resolve to
+        stored = storedTrack(privateInfo['SNG_ID'], quality)
     ext = getExt(quality)
 
     fullFilenamePath = nameFile(trackInfo, albInfo, playlist)
     fullFilenamePathExt = f'{fullFilenamePath}{ext}'
-    if os.path.isfile(fullFilenamePathExt):
+    if stored:
+        metrics.count('store_hits')
+    elif os.path.isfile(fullFilenamePathExt):
         print(f"{fullFilenamePathExt} already exists!")
-        return fullFilenamePathExt
+        stored = fullFilenamePathExt
     else:
-        decryptedUrl = getTrackDownloadUrl(privateInfo, quality)
-        bfKey = getBlowfishKey(privateInfo['SNG_ID'])
-        if downloadTrack(fullFilenamePath, ext, decryptedUrl, bfKey):
-            tags = getTags(trackInfo, albInfo, playlist)
-            if config.getboolean('DEFAULT', 'embed album art'):
-                imageUrl = privateInfo['ALB_PICTURE']
-            else:
-                imageUrl = None
-
-            if quality == '9':
-                writeFlacTags(fullFilenamePathExt, tags, imageUrl)
-            else:
-                writeMP3Tags(fullFilenamePathExt, tags, imageUrl)
+        stored = fetchTrack(trackInfo, albInfo, privateInfo, quality)
+        if not stored:
+            return False
 
-            if config.getboolean('DEFAULT', 'download lyrics'):
-                getLyrics(trackId, fullFilenamePath)
+    if templateLinks:
+        if config.getboolean('DEFAULT', 'embed album art'):
+            imageUrl = privateInfo['ALB_PICTURE'] if privateInfo else albInfo.get('md5_image')
         else:
-            return False
-    return fullFilenamePathExt
+            imageUrl = None
+        if config.getboolean('DEFAULT', 'download lyrics'):
+            linkLyrics(stored, fullFilenamePath)
+        if playlist:
+            # the playlist numbers and names the track, the store keeps
+            # the album's tags
+            stored = copyStored(stored, fullFilenamePathExt,
+                                getTags(trackInfo, albInfo, playlist), imageUrl)
+        else:
+            stored = linkStored(stored, fullFilenamePathExt)
+        if imageUrl:
+            getCoverArt(imageUrl, fullFilenamePathExt, 1500)
+    return stored, formats[qualities.index(quality)]
 
 
-def downloadDeezer(url):
+def recordingOf(privateInfo):
+    ''' What identifies a recording across releases: its ISRC, or the
+        SNG_ID its FALLBACK resolved to when there is none.
+    '''
+    return privateInfo.get('ISRC') or privateInfo['SNG_ID']
+
+
+@onAccount
+def downloadDeezer(url, preferred=None, maxSize=None, templateLinks=True,
+                   recordings=None):
     ''' Extract individual song links from albums and artist pages
         and invokes getTrack(). If it is just a track link,
-        only invoke getTrack().
+        only invoke getTrack(). preferred, maxSize and templateLinks
+        are passed to getTrack(), and what it returns is returned: one
+        (path, format) for a track, a list of them for an album and a
+        list of album lists for an artist.
+        recordings maps recordingOf() to the privateInfo of the first
+        copy of every recording an artist download has seen, album
+        tracks found in it are served from that copy instead.
     '''
     if re.fullmatch(r'(http(|s):\/\/)?(www\.)?(deezer\.com\/(.*?)?)'
                     '(playlist|artist|album|track|)\/[0-9]*', url) is None:
@@ -492,28 +1161,69 @@ def downloadDeezer(url):
         return False
     mediaType, mediaId = deezerTypeId(url)
     if mediaType == 'track':
-        name = getTrack(mediaId)
+        name = getTrack(mediaId, preferred=preferred, maxSize=maxSize,
+                        templateLinks=templateLinks)
         if name:
             print("Done!")
             return name
     # we can't invoke downloadDeezer() again, as in the else block because
     # playlists have a different tracklisting, not available in JSON
     elif mediaType == 'playlist':
-        playlistInfo = getJSON(mediaType, mediaId)
-        ids = [x["id"] for x in playlistInfo['tracks']['data']]
+        # the tracks come page by page
+        playlistInfo = playlistHeader(mediaId)
+        albums = OrderedDict() # the albums of the last tracks
         playlistTrack = 1
-        for trackId in ids:
-            playlist = (playlistInfo, playlistTrack)
-            getTrack(trackId, playlist)
-            playlistTrack += 1
+        for tracks in getJSONPages(mediaType, mediaId, 'tracks'):
+            privateInfos = privateApiBatch([x["id"] for x in tracks
+                                            if not lookupStore(x["id"], preferred, maxSize)])
+            for track in tracks:
+                albumId = track['album']['id']
+                if albumId not in albums:
+                    albums[albumId] = getJSON('album', albumId)
+                    if len(albums) > 16:
+                        albums.popitem(last=False)
+                playlist = (playlistInfo, playlistTrack)
+                getTrack(track['id'], playlist, privateInfos.get(str(track['id'])),
+                         albums[albumId], preferred, maxSize, templateLinks)
+                playlistTrack += 1
+    elif mediaType == 'album':
+        albInfo = getJSON(mediaType, mediaId)
+        print(f"\n{albInfo['artist']['name']} - {albInfo['title']}")
+        names = []
+        for tracks in getJSONPages(mediaType, mediaId, 'tracks'):
+            ids = [x["id"] for x in tracks]
+            if recordings is None:
+                privateInfos = privateApiBatch([trackId for trackId in ids
+                                                if not lookupStore(trackId, preferred, maxSize)])
+            else:
+                # stored tracks need their ISRC too
+                privateInfos = privateApiBatch(ids)
+                for trackId, privateInfo in privateInfos.items():
+                    first = recordings.setdefault(recordingOf(privateInfo), privateInfo)
+                    if first is not privateInfo:
+                        # getTrack() finds the first copy in the store
+                        privateInfos[trackId] = first
+                        metrics.count('duplicate_recordings')
+            names += [getTrack(trackId, privateInfo=privateInfos.get(str(trackId)),
+                               albInfo=albInfo, preferred=preferred, maxSize=maxSize,
+                               templateLinks=templateLinks)
+                      for trackId in ids]
+        return names
     else:
-        subtype = 'albums' if mediaType == 'artist' else 'tracks'
-        info = getJSON(mediaType, mediaId)
-        if mediaType == 'album':
-            print(f"\n{info['artist']['name']} - {info['title']}")
-        info = getJSON(mediaType, mediaId, subtype)
-        urls = [x["link"] for x in info['data']]
-        names = [downloadDeezer(url) for url in urls]
+        # deluxe editions, compilations and singles repeat recordings,
+        # each of them is downloaded once
+        recordings = {}
+        names = []
+        tracks = 0
+        for albums in getJSONPages(mediaType, mediaId, 'albums'):
+            for album in albums:
+                albumNames = downloadDeezer(album["link"], preferred, maxSize,
+                                            templateLinks, recordings)
+                tracks += len(albumNames)
+                names.append(albumNames)
+        duplicates = tracks - len(recordings)
+        if duplicates > 0:
+            print(f"\n{duplicates} duplicate recordings served from their first copy")
         return names
 
 
@@ -628,18 +1338,46 @@ def interactiveMode():
             downloadDeezer(itemUrl)
 
 
+def loadConfig():
+    ''' Reads deezpyrc, once. '''
+    global config
+    if config is None:
+        # other threads see config once it is read
+        settings = configparser.ConfigParser()
+        settings.read(checkSettingsFile())
+        config = settings
+
+
+def userTokens():
+    ''' userToken and the comma separated userTokens of deezpyrc. '''
+    tokens = [config.get('DEFAULT', 'userToken', fallback='')]
+    tokens += config.get('DEFAULT', 'userTokens', fallback='').split(',')
+    return list(dict.fromkeys(token.strip() for token in tokens if token.strip()))
+
+
 def init():
-    if not loginUserToken(config.get('DEFAULT', 'userToken')):
-        print(("Not a valid userToken or the token has expired.\n"
-               "Please edit the userToken in your config file"))
-        exit()
+    ''' Logs the accounts of deezpyrc in, once. Concurrent callers
+        wait for the first one to finish.
+    '''
+    loadConfig()
+    with initLock:
+        if accounts:
+            return
+        for token in userTokens():
+            if not loginUserToken(token):
+                print("Skipping an account: not a valid userToken or the token has expired.")
+        if not accounts:
+            print(("Not a valid userToken or the token has expired.\n"
+                   "Please edit the userToken in your config file"))
+            exit()
 
 
-config = configparser.ConfigParser()
-config.read(checkSettingsFile())
+config = None
 # init()
 
 if __name__ == '__main__':
+    args = parser.parse_args()
+    loadConfig()
     if args.link:
         downloadDeezer(args.link)
     elif args.linkloop:
@@ -0,0 +1,368 @@
+import re
+from datetime import datetime
+from pathlib import Path
+
+from telegram import Bot, InputMediaAudio
+from telegram.utils.request import Request
+
+import deezpy
+import metrics
+from db_handler import (
+    create_track_record,
+    update_track_record,
+    retreive_track_records,
+    retreive_track_records_by_links,
+    retreive_quality_preference,
+    retreive_playlist_snapshot,
+    update_playlist_snapshot,
+    create_download_record,
+)
+from lastfm_handler import get_tags
+from track_store import TrackInfo, track_info
+from utils import timezone_time
+
+
+# Telegram refuses bot uploads over 50 MB, set by configure()
+upload_limit = 50 * 1024 * 1024
+# set by configure() for a self-hosted telegram-bot-api server started with
+# --local, which reads uploads from disk by their file:// uri
+local_bot_api = False
+# audios Telegram accepts in one sendMediaGroup
+media_group_size = 10
+
+
+def configure(config):
+    """Sets the upload mode and limit from config.json."""
+    global upload_limit, local_bot_api
+    local_bot_api = bool(config.get("BOT_API_URL") and config.get("BOT_API_LOCAL"))
+    if local_bot_api:
+        upload_limit = config.get("LOCAL_UPLOAD_LIMIT_MB", 2000) * 1024 * 1024
+    else:
+        upload_limit = config.get("UPLOAD_LIMIT_MB", 50) * 1024 * 1024
+
+
+def create_bot(config, con_pool_size=1):
+    """ The Bot for TELEGRAM_TOKEN, talking to BOT_API_URL when it is set.
+    :param con_pool_size: connections to the Bot API, one per thread that
+        sends at the same time
+    """
+    options = {}
+    if config.get("BOT_API_URL"):
+        base_url = config["BOT_API_URL"]
+        default_file_url = re.sub(r"/bot$", "/file/bot", base_url)
+        options = {
+            "base_url": base_url,
+            "base_file_url": config.get("BOT_API_FILE_URL") or default_file_url,
+        }
+    return Bot(
+        config["TELEGRAM_TOKEN"], request=Request(con_pool_size=con_pool_size), **options
+    )
+
+
+def send_file(bot, chat_id, path, **kwargs):
+    """ send_audio of a downloaded file. A local Bot API server is given
+    its file:// uri and reads it itself, the cloud one gets the bytes.
+    """
+    if local_bot_api:
+        return bot.send_audio(chat_id=chat_id, audio=Path(path).absolute().as_uri(), **kwargs)
+    with open(path, "rb") as audio:
+        return bot.send_audio(chat_id=chat_id, audio=audio, **kwargs)
+
+
+def preferred_quality(chat_id):
+    """The format set with /quality in this chat, or the deezpyrc default."""
+    quality = retreive_quality_preference(chat_id)
+    if quality is None:
+        quality = deezpy.formats[deezpy.preferredQuality()]
+    return quality
+
+
+def best_cached_track(rows, quality):
+    """ The music row in `quality`, or in a worse format that a download
+    asking for `quality` or better fell back to because the better formats
+    were unavailable or over the upload limit. Rows from before formats
+    were recorded match any quality.
+    """
+    rank = deezpy.formats.index(quality)
+    best = None
+    for row in rows:
+        if row[7] is None:
+            row_rank = rank
+        else:
+            row_rank = deezpy.formats.index(row[7])
+            if row_rank > rank and (
+                row[8] is None or deezpy.formats.index(row[8]) > rank
+            ):
+                continue
+        if row_rank >= rank and (best is None or row_rank < best[0]):
+            best = (row_rank, row)
+    return best[1] if best else None
+
+
+def cached_track(link, quality):
+    """The music row to send for `link`, see best_cached_track()."""
+    return best_cached_track(retreive_track_records({"deezer_link": link}), quality)
+
+
+def cached_tracks(links, quality):
+    """ Like cached_track() for many links with a single query.
+    Returns a dict of link -> music row of the links that are cached.
+    """
+    rows = {}
+    for row in retreive_track_records_by_links(links):
+        rows.setdefault(row[2], []).append(row)
+    cached = {}
+    for link, link_rows in rows.items():
+        row = best_cached_track(link_rows, quality)
+        if row is not None:
+            cached[link] = row
+    return cached
+
+
+@metrics.timed("telegram_upload")
+@metrics.tagged("upload")
+def upload_track(bot, chat_id, path, song):
+    """Uploads a downloaded file to `chat_id` with the tags of `song`, a TrackInfo."""
+    return send_file(
+        bot, chat_id, path, title=song.title, performer=song.performers, thumb=song.cover
+    )
+
+
+def download_user(user):
+    """The fields of a telegram User that are stored with every download."""
+    return {
+        "telegram_full_name": user.full_name,
+        "telegram_id": user.id,
+        "telegram_link": user.link,
+        "telegram_name": user.name,
+        "telegram_username": user.username,
+    }
+
+
+def send_tags(bot, chat_id, song):
+    tags = get_tags(song.artist, song.title)
+    if tags is not None:
+        text = ""
+        for i, tag in enumerate(tags):
+            if i == len(tags) - 1:
+                text += f"#{tag}"
+            else:
+                text += f"#{tag}, "
+        try:
+            bot.send_message(chat_id=chat_id, text=text)
+        except:
+            pass
+
+
+def record_upload(file, link, song, downloaded_quality, quality, user):
+    """ Records the upload of `link`, the Message `file`, in the music table
+    and a download of it by `user`.
+    """
+    track = {
+        "telegram_file_id": file.audio.file_id,
+        "deezer_link": link,
+        "download_count": 1,
+        "last_downloaded": timezone_time(datetime.now()),
+        "performer": file.audio.performer,
+        "title": file.audio.title,
+        "quality": downloaded_quality,
+        "requested_quality": quality,
+        "album": song.album,
+        "artist": song.artist,
+    }
+    track_id = create_track_record(track)
+    create_download_record(dict(user, music_id=track_id))
+
+
+def no_stage(state, progress=None):
+    pass
+
+
+def playlist_track_ids(playlist_id):
+    """ The track ids of a deezer playlist and the ones its last snapshot
+    had. While the playlist's checksum stays the same its tracks aren't
+    listed again, and finding that out takes a one track page.
+    """
+    checksum = deezpy.getURL(
+        f"{deezpy.apiUrl}/playlist/{playlist_id}/tracks?index=0&limit=1"
+    )["checksum"]
+    snapshot = retreive_playlist_snapshot(playlist_id)
+    if snapshot is not None and snapshot[0] == checksum:
+        metrics.count("playlist_snapshot_hits")
+        return snapshot[1], snapshot[1]
+    track_ids = [
+        track["id"]
+        for page in deezpy.getJSONPages("playlist", playlist_id, "tracks")
+        for track in page
+    ]
+    update_playlist_snapshot(playlist_id, checksum, track_ids)
+    return track_ids, snapshot[1] if snapshot is not None else []
+
+
+def private_track_info(info):
+    """TrackInfo of a song.getListData entry, see deezpy.privateApiBatch()."""
+    artists = [artist["ART_NAME"] for artist in info.get("ARTISTS", [])]
+    return TrackInfo(
+        info["SNG_TITLE"],
+        ", ".join(artists) or info["ART_NAME"],
+        f"{deezpy.imageUrl}/{info['ALB_PICTURE']}/250x250-000000-80-0-0.jpg",
+        info["ART_NAME"],
+        info["ALB_TITLE"],
+    )
+
+
+def send_cached_tracks(bot, chat_id, rows, user):
+    """Sends music rows by their telegram_file_id, up to media_group_size per message."""
+    for start in range(0, len(rows), media_group_size):
+        group = rows[start:start + media_group_size]
+        with metrics.timer("telegram_send_cached"):
+            if len(group) == 1:
+                bot.send_audio(chat_id=chat_id, audio=group[0][1])
+            else:
+                bot.send_media_group(
+                    chat_id=chat_id, media=[InputMediaAudio(row[1]) for row in group]
+                )
+        for row in group:
+            track_update = {
+                "last_downloaded": timezone_time(datetime.now()),
+                "deezer_link": row[2],
+                "performer": row[5],
+                "title": row[6],
+                "quality": row[7],
+            }
+            update_track_record(track_update)
+            create_download_record(dict(user, music_id=row[0]))
+    metrics.count("cache_hits", len(rows))
+
+
+def deliver_playlist(bot, deezer, chat_id, link, user, stage=no_stage, skip=0):
+    """ Sends every track of a deezer playlist. Tracks already in the music
+    table go out in bulk by file id, the others are resolved together,
+    then downloaded, uploaded and recorded for the next time.
+    """
+    stage("resolving")
+    playlist_id = re.search(r"playlist/(\d+)", link).group(1)
+    track_ids, known_ids = playlist_track_ids(playlist_id)
+    links = [f"https://www.deezer.com/track/{track_id}" for track_id in track_ids]
+    quality = preferred_quality(chat_id)
+    cached = cached_tracks(links, quality)
+    added = len(set(track_ids) - set(known_ids))
+    metrics.count("playlist_tracks_added", added)
+    bot.send_message(
+        chat_id=chat_id,
+        text=f"{len(links)} tracks, {added} new since the last request, {len(cached)} ready to send.",
+    )
+
+    # the tracks to download, in playlist order
+    missing = [
+        track_id
+        for position, (track_id, track_link) in enumerate(zip(track_ids, links))
+        if position >= skip and track_link not in cached
+    ]
+    infos = deezer.resolve_tracks(missing) if missing else {}
+
+    # runs of cached tracks are sent together, in playlist order
+    pending = []
+    for position, track_link in enumerate(links):
+        if position < skip:
+            continue
+        row = cached.get(track_link)
+        if row is not None:
+            pending.append(row)
+            continue
+        stage("uploading", position - len(pending))
+        send_cached_tracks(bot, chat_id, pending, user)
+        pending = []
+        stage("uploading", position)
+        try:
+            info = infos.get(str(track_ids[position]))
+            item = None
+            if info is not None:
+                with metrics.timer("download"):
+                    item = deezer.download_track(track_ids[position], info, quality, upload_limit)
+            if not item:
+                raise ValueError("not available on deezer")
+            path, downloaded_quality = item
+            song = private_track_info(info)
+            file = upload_track(bot, chat_id, path, song)
+            record_upload(file, track_link, song, downloaded_quality, quality, user)
+        except Exception as e:
+            metrics.count("playlist_track_errors")
+            bot.send_message(chat_id=chat_id, text=f"Could not send {track_link}: {e}")
+    stage("uploading", len(links) - len(pending))
+    send_cached_tracks(bot, chat_id, pending, user)
+    stage("done", len(links))
+
+
+def deliver_link(bot, deezer, chat_id, link, user, song=None, stage=no_stage, skip=0):
+    """ Sends the audio behind a deezer `link` to `chat_id`.
+    Links already in the music table are sent by their telegram_file_id,
+    anything else is downloaded, uploaded and recorded.
+    :param user: dict made by download_user()
+    :param song: the TrackInfo of `link`, fetched when not given
+    :param stage: called with each stage of journal.STAGES the delivery
+        reaches, and the number of album tracks uploaded so far
+    :param skip: album tracks an earlier attempt already uploaded
+    """
+    if "/playlist/" in link:
+        deliver_playlist(bot, deezer, chat_id, link, user, stage, skip)
+        return
+    stage("resolving")
+    quality = preferred_quality(chat_id)
+    audio_in_db = cached_track(link, quality)
+
+    if audio_in_db is not None:
+        metrics.count("cache_hits")
+        stage("uploading")
+        bot.send_message(chat_id=chat_id, text="Download done, Uploading...")
+        with metrics.timer("telegram_send_cached"):
+            file = bot.send_audio(chat_id=chat_id, audio=audio_in_db[1])
+
+        track_update = {
+            "last_downloaded": timezone_time(datetime.now()),
+            "deezer_link": link,
+            "performer": file.audio.performer,
+            "title": file.audio.title,
+            "quality": audio_in_db[7],
+        }
+        update_track_record(track_update)
+        create_download_record(dict(user, music_id=audio_in_db[0]))
+        stage("done")
+        return
+
+    metrics.count("cache_misses")
+    stage("downloading")
+    with metrics.timer("download"):
+        items = deezer.download_url(link, quality, upload_limit)
+    stage("tagging")
+    bot.send_message(chat_id=chat_id, text="Download done, Uploading...")
+
+    # fix this! items is not a list of songs
+    # add if update.message has album in it!
+    if isinstance(items, list):
+        # stored path -> telegram_file_id, a recording on several albums
+        # of an artist is uploaded once and resent by its file id
+        file_ids = {}
+        for uploaded, (path, _) in enumerate(items):
+            if uploaded < skip:
+                continue
+            stage("uploading", uploaded)
+            if path in file_ids:
+                metrics.count("duplicate_uploads_avoided")
+                bot.send_audio(chat_id=chat_id, audio=file_ids[path])
+                continue
+            with metrics.tag("upload"):
+                file = send_file(bot, chat_id, path)
+            file_ids[path] = file.audio.file_id
+        stage("done", len(items))
+        return
+
+    path, downloaded_quality = items
+    if song is None:
+        song = track_info(deezer.get_full_track(link.split("/")[-1]))
+    send_tags(bot, chat_id, song)
+    stage("uploading")
+    file = upload_track(bot, chat_id, path, song)
+
+    record_upload(file, link, song, downloaded_quality, quality, user)
+    stage("done")
@@ -0,0 +1,165 @@
+"""
+Journal of the deliveries the bot is working on, so a restart resumes them.
+
+Every link a chat sends becomes a job that moves through the stages
+queued, resolving, downloading, tagging, uploading and done. Unfinished
+jobs are handed back by `unfinished()` on the next start and delivered
+again: downloads resume from their .tmp file in the deezpy store, uploads
+already recorded in the music table are resent by file id, and album jobs
+skip the tracks they already uploaded.
+
+State changes only touch a dict on the hot path. A background thread
+writes the latest state of every changed job in one transaction every
+`flush_interval` seconds, so a crash loses at most that much progress.
+Failed jobs stay for inspection for `failed_ttl` seconds.
+"""
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+STAGES = ("queued", "resolving", "downloading", "tagging", "uploading", "done")
+
+
+class Journal:
+    def __init__(self, db_file, flush_interval=0.5, failed_ttl=7 * 24 * 3600, sweep_interval=3600):
+        self.flush_interval = flush_interval
+        self.failed_ttl = failed_ttl
+        self.sweep_interval = sweep_interval
+        self.conn = sqlite3.connect(db_file, check_same_thread=False)
+        with self.conn:
+            self.conn.execute(
+                """ CREATE TABLE IF NOT EXISTS journal (
+                        id text PRIMARY KEY,
+                        chat_id integer NOT NULL,
+                        link text NOT NULL,
+                        user text NOT NULL,
+                        state text NOT NULL,
+                        progress integer NOT NULL DEFAULT 0,
+                        attempts integer NOT NULL DEFAULT 0,
+                        updated real NOT NULL
+                    ); """
+            )
+        self.lock = threading.Lock()
+        # serializes the flusher thread and unfinished() on self.conn
+        self.db_lock = threading.Lock()
+        # job id -> latest row, or None once the job is done
+        self.pending = {}
+        self.jobs = {}
+        self.stopped = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def start(self, chat_id, link, user, attempts=0, progress=0, replaces=None):
+        """ Journals a new delivery and returns its job id.
+        :param replaces: the id of an unfinished() job this one resumes, its
+            row is deleted in the same transaction the new one is written
+        """
+        job_id = uuid.uuid4().hex
+        row = {
+            "id": job_id,
+            "chat_id": chat_id,
+            "link": link,
+            "user": json.dumps(user),
+            "state": "queued",
+            "progress": progress,
+            "attempts": attempts,
+            "updated": time.time(),
+        }
+        with self.lock:
+            self.jobs[job_id] = row
+            self.pending[job_id] = row
+            if replaces is not None:
+                self.pending[replaces] = None
+        return job_id
+
+    def give_up(self, job):
+        """Marks `job`, one of unfinished(), failed instead of resuming it."""
+        row = dict(job, user=json.dumps(job["user"]), state="failed", updated=time.time())
+        with self.lock:
+            self.pending[job["id"]] = row
+
+    def update(self, job_id, state, progress=None):
+        """Moves a job to `state`, progress counts the album tracks uploaded."""
+        with self.lock:
+            row = self.jobs.get(job_id)
+            if row is None:
+                return
+            row = dict(row, state=state, updated=time.time())
+            if progress is not None:
+                row["progress"] = progress
+            if state in ("done", "failed"):
+                del self.jobs[job_id]
+            else:
+                self.jobs[job_id] = row
+            # done jobs leave the journal, failed ones stay for inspection
+            self.pending[job_id] = None if state == "done" else row
+
+    def stage(self, job_id):
+        """Callback for deliver_link's `stage` argument."""
+        return lambda state, progress=None: self.update(job_id, state, progress)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        done = [(job_id,) for job_id, row in pending.items() if row is None]
+        rows = [row for row in pending.values() if row is not None]
+        with self.db_lock, self.conn:
+            self.conn.executemany("DELETE FROM journal WHERE id=?", done)
+            self.conn.executemany(
+                """ INSERT OR REPLACE INTO journal(id, chat_id, link, user, state, progress, attempts, updated)
+                VALUES (:id, :chat_id, :link, :user, :state, :progress, :attempts, :updated) """,
+                rows,
+            )
+
+    def sweep(self):
+        """Deletes the failed jobs older than failed_ttl seconds."""
+        with self.db_lock, self.conn:
+            self.conn.execute(
+                "DELETE FROM journal WHERE state='failed' AND updated<?",
+                (time.time() - self.failed_ttl,),
+            )
+
+    def flush_loop(self):
+        swept = None
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+            if swept is None or time.monotonic() - swept > self.sweep_interval:
+                self.sweep()
+                swept = time.monotonic()
+
+    def unfinished(self):
+        """ Jobs a previous run didn't finish, as dicts of their columns.
+        Their rows are marked resuming and stay until start(replaces=...)
+        or give_up() takes them over, so a crash before that hands them
+        back again on the next start.
+        """
+        self.flush()
+        with self.db_lock, self.conn:
+            rows = self.conn.execute(
+                """ SELECT id, chat_id, link, user, state, progress, attempts FROM journal
+                WHERE state NOT IN ('done', 'failed') ORDER BY updated """
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE journal SET state='resuming' WHERE id=?", [(row[0],) for row in rows]
+            )
+        return [
+            {
+                "id": job_id,
+                "chat_id": chat_id,
+                "link": link,
+                "user": json.loads(user),
+                "state": state,
+                "progress": progress,
+                "attempts": attempts,
+            }
+            for job_id, chat_id, link, user, state, progress, attempts in rows
+        ]
+
+    def close(self):
+        self.stopped.set()
+        self.flusher.join()
+        self.flush()
@@ -0,0 +1,80 @@
+"""
+Two lanes for the links users send, so cheap requests never wait behind
+expensive ones.
+
+A link already in the music table is delivered with a single send_audio of
+its file id and takes milliseconds, a cold album download takes minutes.
+get_link classifies every link against the cache and submits hits to the
+fast lane and misses to the slow lane, each with its own threads. The slow
+lane admits at most `slow_workers + slow_queue` deliveries at once, further
+misses are shed and the user is asked to try again later.
+
+Each lane records its latency from admission to delivery as the
+lane_fast/lane_slow stages and counts the deliveries that missed its SLO.
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Lanes:
+    def __init__(self, config):
+        """:param config: the parsed config.json"""
+        self.fast_workers = config.get("LANE_FAST_WORKERS", 4)
+        self.slow_workers = config.get("LANE_SLOW_WORKERS", 2)
+        self.slow_queue = config.get("LANE_SLOW_QUEUE", 20)
+        self.slo = {
+            "fast": config.get("LANE_FAST_SLO_MS", 1000) / 1000,
+            "slow": config.get("LANE_SLOW_SLO_S", 300),
+        }
+        self.executors = {
+            "fast": ThreadPoolExecutor(self.fast_workers, thread_name_prefix="lane-fast"),
+            "slow": ThreadPoolExecutor(self.slow_workers, thread_name_prefix="lane-slow"),
+        }
+        self.lock = threading.Lock()
+        # slow lane deliveries admitted and not finished yet
+        self.slow_pending = 0
+
+    def workers(self):
+        return self.fast_workers + self.slow_workers
+
+    def pending(self):
+        return self.slow_pending
+
+    def submit(self, hit, func, *args, **kwargs):
+        """ Runs func(*args, **kwargs) on the fast lane if `hit`, otherwise
+        on the slow lane. Returns False when the slow lane is full.
+        """
+        lane = "fast" if hit else "slow"
+        if not hit:
+            with self.lock:
+                if self.slow_pending >= self.slow_workers + self.slow_queue:
+                    metrics.count("lane_slow_shed")
+                    return False
+                self.slow_pending += 1
+        self.executors[lane].submit(self.run, lane, time.perf_counter(), func, args, kwargs)
+        return True
+
+    def run(self, lane, admitted, func, args, kwargs):
+        metrics.observe(f"lane_{lane}_wait", time.perf_counter() - admitted)
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            logger.warning("Delivery on the %s lane failed: %s", lane, e)
+        finally:
+            if lane == "slow":
+                with self.lock:
+                    self.slow_pending -= 1
+            elapsed = time.perf_counter() - admitted
+            metrics.observe(f"lane_{lane}", elapsed)
+            if elapsed > self.slo[lane]:
+                metrics.count(f"lane_{lane}_slo_misses")
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=False)
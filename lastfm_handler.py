@@ -1,15 +1,23 @@
 import requests
-import json
 
-with open('config.json') as json_config_file:
-    json_config = json.load(json_config_file)
+import metrics
+from utils import load_config
 
-API_KEY = json_config['LASTFM_API_KEY']
+API_KEY = None
+API_URL = "http://ws.audioscrobbler.com/2.0/"
 
 
+def api_key():
+    global API_KEY
+    if API_KEY is None:
+        API_KEY = load_config()['LASTFM_API_KEY']
+    return API_KEY
+
+
+@metrics.timed("lastfm")
 def get_tags(artist, title):
-    # search_result = (requests.get(f"http://ws.audioscrobbler.com/2.0/?method=track.search&track={artist}%20{title}&api_key={API_KEY}&format=json")).json()
-    song_data = (requests.get(f"http://ws.audioscrobbler.com/2.0/?method=track.getInfo&api_key={API_KEY}&artist={artist}&track={title}&format=json")).json()
+    # search_result = (requests.get(f"http://ws.audioscrobbler.com/2.0/?method=track.search&track={artist}%20{title}&api_key={api_key()}&format=json")).json()
+    song_data = (requests.get(f"{API_URL}?method=track.getInfo&api_key={api_key()}&artist={artist}&track={title}&format=json")).json()
     #print(song_data)
     try:
         tags = []
@@ -18,6 +26,3 @@ def get_tags(artist, title):
         return tags
     except:
         return None
-
-
-get_tags('adele','hello')
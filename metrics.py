@@ -0,0 +1,204 @@
+"""
+Per-stage latency timers and counters for the download pipeline.
+
+Every stage keeps its latest samples in a bounded reservoir, quantiles are
+only computed when the metrics are read. Recording a sample is a deque
+append plus two additions under a lock, so timers can sit on hot paths.
+
+    with metrics.timer("getJSON"):
+        ...
+    metrics.count("cache_hits")
+"""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESERVOIR_SIZE = 2048
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Stage:
+    __slots__ = ("samples", "count", "total")
+
+    def __init__(self):
+        self.samples = deque(maxlen=RESERVOIR_SIZE)
+        self.count = 0
+        self.total = 0.0
+
+    def quantiles(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: samples[min(len(samples) - 1, int(len(samples) * q))] for q in QUANTILES}
+
+
+_lock = threading.Lock()
+_stages = {}
+_counters = {}
+_gauges = {}
+# thread ident -> the stages the thread is in, read by profiler.py
+_thread_stages = {}
+
+
+def observe(stage, seconds):
+    with _lock:
+        entry = _stages.get(stage)
+        if entry is None:
+            entry = _stages[stage] = Stage()
+        entry.count += 1
+        entry.total += seconds
+    entry.samples.append(seconds)
+
+
+def count(counter, value=1):
+    with _lock:
+        _counters[counter] = _counters.get(counter, 0) + value
+
+
+def gauge(name, func):
+    """Reports func() as `name` every time the metrics are read."""
+    with _lock:
+        _gauges[name] = func
+
+
+def read_gauges():
+    with _lock:
+        gauges = dict(_gauges)
+    return {name: func() for name, func in gauges.items()}
+
+
+@contextmanager
+def tag(stage):
+    """Tags the profiler samples of this thread with `stage`, without timing it."""
+    ident = threading.get_ident()
+    stages = _thread_stages.setdefault(ident, [])
+    stages.append(stage)
+    try:
+        yield
+    finally:
+        stages.pop()
+        if not stages:
+            _thread_stages.pop(ident, None)
+
+
+def tagged(stage):
+    """Decorator version of tag()."""
+
+    def decorator(func):
+        @wraps(func)
+        def tagged_func(*args, **kwargs):
+            with tag(stage):
+                return func(*args, **kwargs)
+
+        return tagged_func
+
+    return decorator
+
+
+def thread_stages():
+    """The stages every thread is in, outermost first."""
+    return {ident: tuple(stages) for ident, stages in list(_thread_stages.items())}
+
+
+@contextmanager
+def timer(stage):
+    started = time.perf_counter()
+    try:
+        with tag(stage):
+            yield
+    finally:
+        observe(stage, time.perf_counter() - started)
+
+
+def timed(stage):
+    """Decorator version of timer()."""
+
+    def decorator(func):
+        @wraps(func)
+        def timed_func(*args, **kwargs):
+            with timer(stage):
+                return func(*args, **kwargs)
+
+        return timed_func
+
+    return decorator
+
+
+def snapshot():
+    with _lock:
+        stages = {name: (stage.count, stage.total, stage.quantiles()) for name, stage in _stages.items()}
+        counters = dict(_counters)
+    return stages, counters
+
+
+def render_prometheus():
+    stages, counters = snapshot()
+    lines = [
+        "# HELP song_dl_stage_seconds Time spent per download pipeline stage.",
+        "# TYPE song_dl_stage_seconds summary",
+    ]
+    for name, (stage_count, total, quantiles) in sorted(stages.items()):
+        for q, value in quantiles.items():
+            lines.append(f'song_dl_stage_seconds{{stage="{name}",quantile="{q}"}} {value:.6f}')
+        lines.append(f'song_dl_stage_seconds_sum{{stage="{name}"}} {total:.6f}')
+        lines.append(f'song_dl_stage_seconds_count{{stage="{name}"}} {stage_count}')
+    for name, value in sorted(counters.items()):
+        lines.append(f"# TYPE song_dl_{name}_total counter")
+        lines.append(f"song_dl_{name}_total {value}")
+    for name, value in sorted(read_gauges().items()):
+        lines.append(f"# TYPE song_dl_{name} gauge")
+        lines.append(f"song_dl_{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def render_stats():
+    """Plain text summary for the /stats command."""
+    stages, counters = snapshot()
+    lines = []
+    for name, (stage_count, total, quantiles) in sorted(stages.items()):
+        p50, p95, p99 = (quantiles[q] * 1000 for q in QUANTILES)
+        lines.append(f"{name}: n={stage_count} p50={p50:.0f}ms p95={p95:.0f}ms p99={p99:.0f}ms")
+    for name, value in sorted(counters.items()):
+        lines.append(f"{name}: {value}")
+    for name, value in sorted(read_gauges().items()):
+        lines.append(f"{name}: {value}")
+    hits, misses = counters.get("cache_hits", 0), counters.get("cache_misses", 0)
+    if hits + misses:
+        lines.append(f"cache hit rate: {hits / (hits + misses):.0%}")
+    for lane in ("fast", "slow"):
+        if f"lane_{lane}" in stages:
+            delivered = stages[f"lane_{lane}"][0]
+            missed = counters.get(f"lane_{lane}_slo_misses", 0)
+            lines.append(f"{lane} lane within SLO: {1 - missed / delivered:.0%}")
+    started = counters.get("speculation_started", 0)
+    if started:
+        lines.append(f"speculation hit rate: {counters.get('speculation_hits', 0) / started:.0%}")
+    return "\n".join(lines) or "No requests yet."
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(listen, port):
+    """Serves render_prometheus() on http://listen:port/metrics."""
+    httpd = ThreadingHTTPServer((listen, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
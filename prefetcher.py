@@ -0,0 +1,140 @@
+"""
+Background prefetcher that warms the `music` cache during off-peak hours.
+
+Candidates are the top songs and new releases of the artists behind our most
+downloaded tracks. Every candidate is downloaded, tagged and uploaded to a
+cache channel so it already has a `telegram_file_id` when a user asks for it.
+"""
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+
+from budget import Budget, today
+import deezpy
+from db_handler import create_track_record, retreive_track_record, retreive_popular_tracks
+from deezer_handler import DeezerHandler
+import delivery
+from delivery import upload_track
+from track_store import track_info
+from utils import local_now, timezone_time
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    def __init__(self, bot, queue_depth, config):
+        """
+        :param bot: telegram Bot used to upload to the cache channel
+        :param queue_depth: callable returning the number of pending user updates
+        :param config: the parsed config.json
+        """
+        self.bot = bot
+        self.channel_id = config["PREFETCH_CHANNEL_ID"]
+        self.start_hour, self.end_hour = config.get("PREFETCH_HOURS", [2, 7])
+        self.budget = Budget(
+            queue_depth,
+            config.get("PREFETCH_MAX_QUEUE_DEPTH", 0),
+            config.get("PREFETCH_BANDWIDTH_MB", 500) * 1024 * 1024,
+            today,
+        )
+        self.seed_count = config.get("PREFETCH_SEED_TRACKS", 20)
+        self.release_days = config.get("PREFETCH_RELEASE_DAYS", 30)
+        # the thread of the prefetch in progress
+        self.thread = None
+
+    def is_off_peak(self):
+        hour = local_now().hour
+        if self.start_hour <= self.end_hour:
+            return self.start_hour <= hour < self.end_hour
+        return hour >= self.start_hour or hour < self.end_hour
+
+    def candidates(self, deezer):
+        """Yields deezer track links that are likely to be requested soon."""
+        artist_ids = []
+        for link in retreive_popular_tracks(self.seed_count):
+            if "track" not in link:
+                continue
+            try:
+                artist_id = deezer.get_full_track(link.split("/")[-1]).artist.id
+            except Exception as e:
+                logger.warning("Could not resolve artist of %s: %s", link, e)
+                continue
+            if artist_id not in artist_ids:
+                artist_ids.append(artist_id)
+
+        since = (local_now() - timedelta(days=self.release_days)).strftime("%Y-%m-%d")
+        seen = set()
+        for artist_id in artist_ids:
+            tracks = list(deezer.get_top_songs_of_artist(artist_id))
+            for album in deezer.get_albums_of_artist(artist_id):
+                if getattr(album, "release_date", "") >= since:
+                    tracks.extend(deezer.get_album_songs(album.id))
+            for track in tracks:
+                if track.link in seen:
+                    continue
+                seen.add(track.link)
+                if retreive_track_record({"deezer_link": track.link}) is None:
+                    yield track
+
+    def prefetch_track(self, deezer, track):
+        quality = deezpy.formats[deezpy.preferredQuality()]
+        stored = deezer.stored_track(track.id, quality, delivery.upload_limit)
+        downloaded = deezer.download_url(track.link, quality, delivery.upload_limit)
+        if not downloaded or isinstance(downloaded, list):
+            return False
+        path, downloaded_quality = downloaded
+        # the bandwidth is spent even if the upload fails, a stored track
+        # costs none
+        if not stored:
+            self.budget.spend(os.path.getsize(path))
+        song = track_info(deezer.get_full_track(track.id))
+        file = upload_track(self.bot, self.channel_id, path, song)
+        create_track_record(
+            {
+                "telegram_file_id": file.audio.file_id,
+                "deezer_link": track.link,
+                "download_count": 0,
+                "last_downloaded": timezone_time(datetime.now()),
+                "performer": file.audio.performer,
+                "title": file.audio.title,
+                "quality": downloaded_quality,
+                "requested_quality": quality,
+                "album": song.album,
+                "artist": song.artist,
+            }
+        )
+        return True
+
+    def run(self, context=None):
+        """ Job callback, meant to be scheduled with `job_queue.run_repeating`.
+        The prefetch runs on its own thread so it doesn't hold up the other
+        jobs, and is skipped while the previous one is still running.
+        """
+        if not self.is_off_peak() or self.budget.is_busy() or self.budget.left() <= 0:
+            return
+        if self.thread is not None and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.prefetch, name="prefetcher", daemon=True)
+        self.thread.start()
+
+    def prefetch(self):
+        deezer = DeezerHandler()
+        fetched = 0
+        for track in self.candidates(deezer):
+            if self.budget.is_busy():
+                logger.info("Users are waiting, pausing prefetch")
+                break
+            if not self.is_off_peak() or self.budget.left() <= 0:
+                break
+            try:
+                if self.prefetch_track(deezer, track):
+                    fetched += 1
+            except Exception as e:
+                logger.warning("Prefetching %s failed: %s", track.link, e)
+        logger.info(
+            "Prefetched %d tracks, %d of %d bytes used today",
+            fetched,
+            self.budget.used,
+            self.budget.limit,
+        )
@@ -0,0 +1,88 @@
+"""
+On-demand sampling profiler for a running bot or worker process.
+
+While a profile runs, a thread takes the stack of every other thread of the
+process each `interval` seconds with sys._current_frames(). Nothing is
+installed in the profiled threads, so requests run at full speed when no
+profile is running and nearly so while one is.
+
+Samples are tagged with the pipeline stages their thread is in
+(metrics.timer() and metrics.tag(), e.g. getTrack, downloadTrack,
+writeFlacTags, upload) and written in the collapsed-stack format that
+flamegraph.pl and speedscope read:
+
+    thread;[getTrack];[downloadTrack];deezpy.py:downloadTrack;... 42
+"""
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+import metrics
+
+
+class SamplingProfiler:
+    def __init__(self, interval=0.005, max_seconds=300):
+        self.interval = interval
+        # a profile waiting for requests stops after this long anyway
+        self.max_seconds = max_seconds
+        self.lock = threading.Lock()
+        self.running = False
+        self.requests = 0
+
+    def request_done(self):
+        """Counts a handled request towards profile(requests=N)."""
+        if self.running:
+            with self.lock:
+                self.requests += 1
+
+    def profile(self, seconds=None, requests=None):
+        """ Samples every thread for `seconds`, or until `requests` more
+        requests are handled, and returns the collapsed stacks.
+        Raises RuntimeError if a profile is already running.
+        """
+        with self.lock:
+            if self.running:
+                raise RuntimeError("A profile is already running")
+            self.running = True
+            self.requests = 0
+        deadline = time.monotonic() + (seconds or self.max_seconds)
+        stacks = Counter()
+        own = threading.get_ident()
+        try:
+            while time.monotonic() < deadline and (requests is None or self.requests < requests):
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                stages = metrics.thread_stages()
+                for ident, frame in sys._current_frames().items():
+                    if ident != own:
+                        stacks[collapse(names.get(ident, "thread"), stages.get(ident, ()), frame)] += 1
+                time.sleep(self.interval)
+        finally:
+            with self.lock:
+                self.running = False
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    def profile_to_file(self, folder, seconds=None, requests=None):
+        """profile() written to a .collapsed file in `folder`, returns its path."""
+        collapsed = self.profile(seconds, requests)
+        path = os.path.join(
+            folder, f"profile-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.collapsed"
+        )
+        with open(path, "w") as f:
+            f.write(collapsed)
+        return path
+
+
+def collapse(thread_name, stages, frame):
+    """One sample as a collapsed stack, the thread and its stages first."""
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    # pool threads differ only by their number
+    root = [re.sub(r"\d+", "N", thread_name)]
+    root += [f"[{stage}]" for stage in stages]
+    return ";".join(root + frames[::-1]).replace(" ", "_")
@@ -12,19 +12,30 @@ Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 import logging
+import os
+import signal
+import tempfile
+import threading
 from uuid import uuid4
-from lastfm_handler import get_tags
 
-from telegram import InlineQueryResultArticle, ParseMode, InputTextMessageContent
+from telegram import (
+    InlineQueryResultArticle,
+    InlineQueryResultCachedAudio,
+    ParseMode,
+    InputTextMessageContent,
+)
 from telegram.ext import (
     Updater,
     InlineQueryHandler,
+    ChosenInlineResultHandler,
     CommandHandler,
     ConversationHandler,
     MessageHandler,
     CallbackQueryHandler,
+    TypeHandler,
 )
 from telegram import (
+    Update,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
     InlineKeyboardButton,
@@ -37,22 +48,30 @@ from telegram.utils.helpers import escape_markdown
 from telegram.ext.filters import Filters
 
 from deezer_handler import DeezerHandler
+from journal import Journal
+import delivery
+from delivery import (
+    cached_track,
+    cached_tracks,
+    deliver_link,
+    download_user,
+    preferred_quality,
+)
+from broker import create_broker
+from lanes import Lanes
+import metrics
+from prefetcher import Prefetcher
+from profiler import SamplingProfiler
+from speculator import Speculator
+from track_store import track_info, tracks
+from webhook import WebhookServer
 from db_handler import (
-    create_track_record,
-    update_track_record,
-    retreive_track_record,
-    create_music_table,
-    alter_music_table_add_music_info,
-    create_download_table,
-    create_download_record,
-    retreive_download_history
+    init_db,
+    retreive_download_history,
+    retreive_quality_preference,
+    update_quality_preference,
+    search_tracks,
 )
-from datetime import datetime
-from utils import timezone_time
-
-create_music_table()
-alter_music_table_add_music_info()
-create_download_table()
 
 # Enable logging
 logging.basicConfig(
@@ -61,6 +80,27 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# set in main() when downloads are handed to worker processes
+broker = None
+# set in main(), journals the deliveries of this process unless a broker does
+journal = None
+journal_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "journal.db")
+# deliveries a restart interrupted this often are given up
+JOURNAL_MAX_ATTEMPTS = 3
+# resumed deliveries the slow lane had no room for are tried again this late
+RESUME_RETRY_SECONDS = 60
+# set in main() when SPECULATE is on
+speculator = None
+# set in main(), runs the deliveries of get_link
+lanes = None
+profiler = SamplingProfiler()
+# telegram user ids allowed to use the admin commands, set in main()
+admin_ids = []
+# inline queries with fewer local catalog hits than this also search deezer
+local_results_enough = 5
+# /quality arguments and the deezer formats they stand for
+quality_choices = {"flac": "FLAC", "320": "MP3_320", "256": "MP3_256", "128": "MP3_128"}
+
 
 from functools import wraps
 
@@ -81,6 +121,18 @@ def send_action(action):
     return decorator
 
 
+def admin_only(func):
+    """Ignores `func` commands from users not listed in ADMIN_IDS."""
+
+    @wraps(func)
+    def command_func(update, context, *args, **kwargs):
+        if update.effective_user.id not in admin_ids:
+            return
+        return func(update, context, *args, **kwargs)
+
+    return command_func
+
+
 send_typing_action = send_action(ChatAction.TYPING)
 send_upload_video_action = send_action(ChatAction.UPLOAD_VIDEO)
 send_upload_photo_action = send_action(ChatAction.UPLOAD_PHOTO)
@@ -106,6 +158,66 @@ def get_download_history(update, context):
     context.bot.send_document(document=open('download_history.txt', 'rb'), chat_id=chat_id)
 #    update.message.reply_text(retreive_download_history())
 
+@admin_only
+def stats(update, context):
+    """Send the per stage latencies when the command /stats is issued."""
+    update.message.reply_text(metrics.render_stats())
+
+def send_profile(bot, chat_ids, seconds=None, requests=None):
+    """Runs the profiler and sends the collapsed stacks to `chat_ids`."""
+    try:
+        path = profiler.profile_to_file(tempfile.gettempdir(), seconds, requests)
+    except RuntimeError as e:
+        for chat_id in chat_ids:
+            bot.send_message(chat_id=chat_id, text=str(e))
+        return
+    logger.info("Profile written to %s", path)
+    for chat_id in chat_ids:
+        with open(path, "rb") as document:
+            bot.send_document(chat_id=chat_id, document=document)
+
+
+@admin_only
+def profile(update, context):
+    """ Profile every thread with /profile [seconds], or /profile requests N
+    to stop after N handled updates, and send the collapsed stacks.
+    """
+    args = context.args or []
+    try:
+        if len(args) == 2 and args[0] == "requests":
+            seconds, requests = None, int(args[1])
+        else:
+            seconds, requests = float(args[0]) if args else 30, None
+    except ValueError:
+        update.message.reply_text("Usage: /profile [seconds] or /profile requests N")
+        return
+    update.message.reply_text("Profiling...")
+    threading.Thread(
+        target=send_profile,
+        args=(context.bot, [update.message.chat_id], seconds, requests),
+        daemon=True,
+    ).start()
+
+
+def count_request(update, context):
+    profiler.request_done()
+
+
+def quality(update, context):
+    """Set the preferred audio format of this chat with /quality flac|320|256|128.
+    Bigger formats are only sent when they fit the upload limit.
+    """
+    chat_id = update.message.chat_id
+    if not context.args or context.args[0].lower() not in quality_choices:
+        current = retreive_quality_preference(chat_id) or "default"
+        update.message.reply_text(
+            f"Current quality: {current}\nUsage: /quality flac|320|256|128"
+        )
+        return
+    chosen = quality_choices[context.args[0].lower()]
+    update_quality_preference(chat_id, chosen)
+    update.message.reply_text(f"Quality set to {chosen}")
+
 def get_message(update, context):
     keyboard = [
         #[
@@ -134,111 +246,135 @@ def get_message(update, context):
 # use it in a for to get albums.
 @send_upload_file_action
 def get_link(update, context):
-    deezer = DeezerHandler()
     chat_id = update.message.chat_id
-
-    update.message.reply_text("Downloading...")
-    track_retreive = {
-        "deezer_link": update.message.text,
-    }
-    audio_in_db = retreive_track_record(track_retreive)
-    
-    if audio_in_db is None:
-        items = deezer.download_url(update.message.text)
-    else:
-        update.message.reply_text("Download done, Uploading...")
-        file = context.bot.send_audio(chat_id=chat_id, audio=audio_in_db[1])
-        
-        track_update = {
-            "last_downloaded": timezone_time(datetime.now()),
-            "deezer_link": update.message.text,
-            "performer": file.audio.performer,
-            "title":file.audio.title
-        }
-        update_track_record(track_update)
-        download_record = {
-            "telegram_full_name":update.message.from_user.full_name,
-            "telegram_id":update.message.from_user.id,
-            "telegram_link":update.message.from_user.link,
-            "telegram_name":update.message.from_user.name,
-            "telegram_username":update.message.from_user.username,
-            "music_id":audio_in_db[0]
-        }
-        create_download_record(download_record)
-        
+    link = update.message.text
+    user = download_user(update.message.from_user)
+
+    # links in the cache are a single send_audio, they go to the fast
+    # lane and never wait behind downloads
+    hit = cached_track(link, preferred_quality(chat_id)) is not None
+    if broker is not None and not hit:
+        update.message.reply_text("Downloading...")
+        broker.put({"chat_id": chat_id, "link": link, "user": user})
         return
-    update.message.reply_text("Download done, Uploading...")
 
-    # fix this! items is not a list of songs
-    # add if update.message has album in it!
-    if isinstance(items, list):
-        for item in items:
-            context.bot.send_audio(chat_id=chat_id, audio=open(item, "rb"))
-    else:
-        try:
-            song = context.user_data["data_dict"][update.message.text]
-        except:
-            context.user_data["data_dict"] = {}
-            song = deezer.get_full_track(update.message.text.split("/")[-1])
-
-        authors = []
-        for author in song.contributors:
-            authors.append(author["name"])
-        author_names = ", ".join(authors)
-        tags = get_tags(song.artist.name, song.title)
-        if tags is not None:
-            text = ""
-            for i, tag in enumerate(tags):
-                if i == len(tags) - 1:
-                    text += f"#{tag}"
-                else:
-                    text += f"#{tag}, "
-            try:
-                context.bot.send_message(chat_id=chat_id, text=text)
-            except:
-                pass
-        file = context.bot.send_audio(
-            chat_id=chat_id,
-            audio=open(items, "rb"),
-            title=song.title,
-            performer=author_names,
-            thumb=song.album.cover_medium,
+    song = None
+    if "/track/" in link:
+        song = tracks.get(link.split("/")[-1])
+    job_id = None if journal is None else journal.start(chat_id, link, user)
+    if not lanes.submit(hit, deliver, context.bot, chat_id, link, user, song, job_id=job_id):
+        if job_id is not None:
+            journal.update(job_id, "done")
+        update.message.reply_text("Too many downloads right now, please try again later.")
+        return
+    if not hit:
+        update.message.reply_text("Downloading...")
+
+
+def deliver(bot, chat_id, link, user, song=None, attempts=0, skip=0, job_id=None):
+    """ deliver_link() recorded in the journal, so a restart resumes it.
+    :param job_id: the journal job when the caller already started it
+    """
+    if speculator is not None:
+        speculator.claim(link)
+    if journal is None:
+        deliver_link(bot, DeezerHandler(), chat_id, link, user, song)
+        return
+    if job_id is None:
+        job_id = journal.start(chat_id, link, user, attempts, skip)
+    try:
+        deliver_link(
+            bot, DeezerHandler(), chat_id, link, user, song, journal.stage(job_id), skip
         )
-
-        track = {
-            "telegram_file_id": file.audio.file_id,
-            "deezer_link": update.message.text,
-            "download_count": 1,
-            "last_downloaded": timezone_time(datetime.now()),
-            "performer": file.audio.performer,
-            "title": file.audio.title,
-        }
-        track_id = create_track_record(track)
-        
-        download_record = {
-            "telegram_full_name":update.message.from_user.full_name,
-            "telegram_id":update.message.from_user.id,
-            "telegram_link":update.message.from_user.link,
-            "telegram_name":update.message.from_user.name,
-            "telegram_username":update.message.from_user.username,
-            "music_id":track_id
-        }
-        create_download_record(download_record)
-        context.user_data["data_dict"] = {}
+    except Exception:
+        journal.update(job_id, "failed")
+        raise
+
+
+def resume_jobs(context):
+    """ Job callback that finishes the deliveries the last run was working on.
+    They go through the lanes like new links, the ones the slow lane has no
+    room for are journaled again and retried RESUME_RETRY_SECONDS later.
+    """
+    jobs = context.job.context or journal.unfinished()
+    waiting = []
+    for job in jobs:
+        if "job_id" not in job:
+            if job["attempts"] + 1 >= JOURNAL_MAX_ATTEMPTS:
+                logger.warning("Giving up on %s for %s", job["link"], job["chat_id"])
+                journal.give_up(job)
+                context.bot.send_message(
+                    chat_id=job["chat_id"], text="Sorry, downloading this link failed."
+                )
+                continue
+            logger.info("Resuming %s for %s from %s", job["link"], job["chat_id"], job["state"])
+            job["job_id"] = journal.start(
+                job["chat_id"],
+                job["link"],
+                job["user"],
+                job["attempts"] + 1,
+                job["progress"],
+                replaces=job["id"],
+            )
+        hit = cached_track(job["link"], preferred_quality(job["chat_id"])) is not None
+        if not lanes.submit(
+            hit,
+            deliver,
+            context.bot,
+            job["chat_id"],
+            job["link"],
+            job["user"],
+            skip=job["progress"],
+            job_id=job["job_id"],
+        ):
+            waiting.append(job)
+    if waiting:
+        logger.info("Slow lane is full, resuming %d deliveries later", len(waiting))
+        context.job_queue.run_once(resume_jobs, RESUME_RETRY_SECONDS, context=waiting)
+
+
+def local_tracks(query, limit):
+    """ Tracks we already delivered that match `query`, most downloaded
+    first, as a dict of deezer link -> (title, performer).
+    """
+    tracks = {}
+    for music_id, file_id, link, count, performer, title, album, artist in search_tracks(query, limit):
+        tracks.setdefault(link, (title or link, performer or artist))
+    return tracks
+
+
+def track_result_id(link):
+    """ Inline result id of a deezer track link. chosen_inline_result gets
+    the link back from it with result_link().
+    """
+    return f"{link.split('/')[-1]}:{uuid4().hex[:8]}"
+
+
+def result_link(result_id):
+    """The deezer track link of a track_result_id(), or None."""
+    track_id = result_id.split(":")[0]
+    if not track_id.isdigit():
+        return None
+    return f"https://www.deezer.com/track/{track_id}"
+
+
+def cached_audio_result(row):
+    """Inline result that sends the audio of a music row by its file id."""
+    return InlineQueryResultCachedAudio(id=uuid4(), audio_file_id=row[1])
 
 
 def inlinequery(update, context):
     """Handle the inline query."""
     deezer = DeezerHandler()
     query = update.inline_query.query
-    data_dict = {}
+    # the first result that isn't sent by file id, see SPECULATE_TOP_RESULT
+    top_link = None
     if query.startswith("Artist:"):
         artist_name = query[7:]
 
         results = []
         item = None
         for item in deezer.get_artist(artist_name)[:15]:
-            data_dict[item.link] = item
             results.append(
                 InlineQueryResultArticle(
                     id=uuid4(),
@@ -254,7 +390,6 @@ def inlinequery(update, context):
         results = []
         item = None
         for item in deezer.get_album(album_name)[:5]:
-            data_dict[item.link] = item
             results.append(
                 InlineQueryResultArticle(
                     id=uuid4(),
@@ -267,21 +402,64 @@ def inlinequery(update, context):
     else:
         song = query
 
-        results = []
+        local = local_tracks(query, 15)
         item = None
-        for item in deezer.get_song(song)[:15]:
-            data_dict[item.link] = deezer.get_full_track(item.id)
+        if len(local) >= local_results_enough:
+            deezer_results = []
+        else:
+            deezer_results = [
+                item for item in deezer.get_song(song)[:15 - len(local)]
+                if item.link not in local
+            ]
+        # tracks in the music table are sent straight from telegram
+        cached = cached_tracks(
+            list(local) + [item.link for item in deezer_results],
+            preferred_quality(update.inline_query.from_user.id),
+        )
+        metrics.count("inline_cached_results", len(cached))
+
+        results = []
+        for link, (title, performer) in local.items():
+            if link in cached:
+                results.append(cached_audio_result(cached[link]))
+                continue
+            top_link = top_link or link
             results.append(
                 InlineQueryResultArticle(
-                    id=uuid4(),
+                    id=track_result_id(link),
+                    title=title,
+                    input_message_content=InputTextMessageContent(link),
+                    description=performer,
+                )
+            )
+        for item in deezer_results:
+            if item.link in cached:
+                results.append(cached_audio_result(cached[item.link]))
+                continue
+            # get_link tags the upload with these, no deezer call then
+            if tracks.get(item.id) is None:
+                tracks.put(item.id, track_info(deezer.get_full_track(item.id)))
+            top_link = top_link or item.link
+            results.append(
+                InlineQueryResultArticle(
+                    id=track_result_id(item.link),
                     title=item.title,
                     thumb_url=item.get_album().cover_medium,
                     input_message_content=InputTextMessageContent(item.link),
                     description=item.artist.name,
                 )
             )
-    context.user_data["data_dict"] = data_dict
     update.inline_query.answer(results)
+    if speculator is not None and speculator.top_result and top_link:
+        speculator.speculate(top_link, update.inline_query.from_user.id)
+
+
+def chosen_inline_result(update, context):
+    """Starts downloading the track the user just picked, before its link arrives."""
+    chosen = update.chosen_inline_result
+    link = result_link(chosen.result_id)
+    if speculator is not None and link is not None:
+        speculator.speculate(link, chosen.from_user.id)
 
 
 def error(update, context):
@@ -299,18 +477,56 @@ def button(update, context):
     # query.edit_message_text(text="Selected option: {}".format(query.data))
 
 
+def serve_webhook(updater, webhook_server, webhook_url):
+    """Runs the bot on `webhook_server` until SIGINT or SIGTERM."""
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda signum, frame: stop.set())
+
+    updater.job_queue.start()
+    webhook_server.start()
+    updater.bot.set_webhook(url=f"{webhook_url}{webhook_server.path}")
+    while not stop.wait(1):
+        pass
+    webhook_server.stop()
+    updater.job_queue.stop()
+
+
 def main():
+    global broker, admin_ids, speculator, journal, lanes
     import json
 
     with open('config.json') as json_config_file:
         json_config = json.load(json_config_file)
-    TELEGRAM_TOKEN = json_config['TELEGRAM_TOKEN'] 
-    # Create the Updater and pass it your bot's token.
+    if json_config.get("DOWNLOAD_MODE") == "broker":
+        # downloads run in worker.py processes, this one only takes updates
+        broker = create_broker(json_config)
+    else:
+        journal = Journal(
+            json_config.get("JOURNAL_PATH") or journal_path,
+            failed_ttl=json_config.get("JOURNAL_FAILED_DAYS", 7) * 24 * 3600,
+        )
+    admin_ids = json_config.get("ADMIN_IDS", [])
+    lanes = Lanes(json_config)
+    metrics.gauge("lane_slow_pending", lanes.pending)
+    init_db()
+    tracks.max_bytes = json_config.get("TRACK_STORE_MB", 8) * 1024 * 1024
+    DeezerHandler.timeout = json_config.get("DEEZER_TIMEOUT", 10)
+    DeezerHandler.cache_size = json_config.get("DEEZER_CACHE_SIZE", 1024)
+    metrics.gauge("track_store_bytes", tracks.memory_bytes)
+    metrics.gauge("track_store_records", lambda: len(tracks))
+    delivery.configure(json_config)
+    if json_config.get("METRICS_PORT"):
+        metrics.start_http_server(
+            json_config.get("METRICS_LISTEN", "127.0.0.1"), json_config["METRICS_PORT"]
+        )
+    TELEGRAM_TOKEN = json_config['TELEGRAM_TOKEN']
+    # Create the Updater and pass it your bot, with a connection for each
+    # of its 4 workers, its 4 own threads and the lanes' threads.
     # Make sure to set use_context=True to use the new context based callbacks
     # Post version 12 this will no longer be necessary
-    updater = Updater(
-        TELEGRAM_TOKEN, use_context=True
-    )
+    bot = delivery.create_bot(json_config, con_pool_size=8 + lanes.workers())
+    updater = Updater(bot=bot, use_context=True)
 
     # Get the dispatcher to register handlers
     dp = updater.dispatcher
@@ -319,6 +535,9 @@ def main():
     dp.add_handler(CommandHandler("start", start))
     dp.add_handler(CommandHandler("help", help))
     dp.add_handler(CommandHandler("get_download_history", get_download_history))
+    dp.add_handler(CommandHandler("stats", stats))
+    dp.add_handler(CommandHandler("profile", profile))
+    dp.add_handler(CommandHandler("quality", quality))
     dp.add_handler(
         MessageHandler(
             Filters.text
@@ -333,17 +552,68 @@ def main():
 
     # on noncommand i.e message - echo the message on Telegram
     dp.add_handler(InlineQueryHandler(inlinequery))
+    dp.add_handler(ChosenInlineResultHandler(chosen_inline_result))
+
+    # runs after the handlers of group 0, counts updates for /profile requests N
+    dp.add_handler(TypeHandler(Update, count_request), group=1)
 
     # log all errors
     dp.add_error_handler(error)
 
-    # Start the Bot
-    updater.start_polling()
+    # kill -USR1 <pid> profiles the bot and sends the result to the admins
+    if hasattr(signal, "SIGUSR1"):
+        seconds = json_config.get("PROFILE_SIGNAL_SECONDS", 30)
+        signal.signal(
+            signal.SIGUSR1,
+            lambda signum, frame: threading.Thread(
+                target=send_profile, args=(updater.bot, admin_ids, seconds), daemon=True
+            ).start(),
+        )
+
+    webhook_server = None
+    queue_depth = dp.update_queue.qsize
+    if json_config.get("WEBHOOK_URL"):
+        webhook_server = WebhookServer(
+            dp,
+            json_config.get("WEBHOOK_LISTEN", "0.0.0.0"),
+            json_config.get("WEBHOOK_PORT", 8443),
+            json_config.get("WEBHOOK_PATH") or f"/{TELEGRAM_TOKEN}",
+            workers=json_config.get("WEBHOOK_WORKERS", 4),
+            max_queue=json_config.get("WEBHOOK_MAX_QUEUE", 100),
+        )
+        queue_depth = webhook_server.queue_depth
+
+    def waiting_users():
+        # downloads in the slow lane count as waiting users too
+        return queue_depth() + lanes.pending()
+
+    if journal is not None:
+        updater.job_queue.run_once(resume_jobs, 0)
+
+    # start downloading picked inline results before their link message
+    if json_config.get("SPECULATE") and broker is None:
+        speculator = Speculator(waiting_users, json_config)
 
-    # Block until the user presses Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    # warm the cache with trending tracks while users are idle
+    if json_config.get("PREFETCH_CHANNEL_ID"):
+        prefetcher = Prefetcher(updater.bot, waiting_users, json_config)
+        updater.job_queue.run_repeating(
+            prefetcher.run, interval=json_config.get("PREFETCH_INTERVAL", 600)
+        )
+
+    if webhook_server is not None:
+        serve_webhook(updater, webhook_server, json_config["WEBHOOK_URL"])
+    else:
+        # Start the Bot
+        updater.start_polling()
+
+        # Block until the user presses Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
+    lanes.shutdown()
+    if journal is not None:
+        journal.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,109 @@
+"""
+Speculative downloads of the tracks users are about to ask for.
+
+When a user picks an inline result (a ChosenInlineResult update, needs
+/setinlinefeedback in BotFather) the link message is still on its way to
+us. The Speculator starts downloading the track into the deezpy store right
+away, so by the time get_link runs the file is there or half way there.
+Optionally the top result of every inline query is speculated on too.
+
+Speculation runs on its own small thread pool and never competes with real
+requests: nothing starts while users are waiting on the update queue or
+once the hourly bandwidth budget is used up, a newer pick of the same user
+cancels their older speculation if it hasn't started, and a real request
+for a speculated link either cancels it or waits for it instead of
+downloading the track a second time.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from budget import Budget, this_hour
+import delivery
+import metrics
+from db_handler import retreive_track_record
+from deezer_handler import DeezerHandler
+
+logger = logging.getLogger(__name__)
+
+# finished speculations kept around for the get_link that claims them
+MAX_TRACKED = 256
+
+
+class Speculator:
+    def __init__(self, queue_depth, config):
+        """
+        :param queue_depth: callable returning the number of pending user updates
+        :param config: the parsed config.json
+        """
+        self.budget = Budget(
+            queue_depth,
+            config.get("SPECULATE_MAX_QUEUE_DEPTH", 0),
+            config.get("SPECULATE_BANDWIDTH_MB", 200) * 1024 * 1024,
+            this_hour,
+        )
+        self.top_result = config.get("SPECULATE_TOP_RESULT", False)
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.get("SPECULATE_WORKERS", 1),
+            thread_name_prefix="speculator",
+        )
+        self.lock = threading.Lock()
+        # link -> Future, and user id -> link of their latest speculation
+        self.futures = {}
+        self.latest = {}
+
+    def speculate(self, link, user_id):
+        """Starts downloading the deezer track `link` for `user_id`, if allowed."""
+        if "/track/" not in link:
+            return
+        quality = delivery.preferred_quality(user_id)
+        with self.lock:
+            if link in self.futures:
+                return
+            if self.budget.is_busy() or self.budget.left() <= 0:
+                metrics.count("speculation_skipped")
+                return
+            older = self.futures.get(self.latest.get(user_id))
+            if older is not None and older.cancel():
+                del self.futures[self.latest[user_id]]
+                metrics.count("speculation_cancelled")
+            self.futures[link] = self.executor.submit(self.download, link, quality)
+            self.latest[user_id] = link
+            while len(self.futures) > MAX_TRACKED:
+                del self.futures[next(iter(self.futures))]
+        metrics.count("speculation_started")
+
+    def download(self, link, quality):
+        if self.budget.is_busy():
+            metrics.count("speculation_skipped")
+            return
+        if retreive_track_record({"deezer_link": link}) is not None:
+            return
+        deezer = DeezerHandler()
+        # a stored track costs no bandwidth, it is already where get_link looks
+        if deezer.stored_track(link.split("/")[-1], quality, delivery.upload_limit):
+            metrics.count("speculation_stored")
+            return
+        with metrics.timer("speculative_download"):
+            downloaded = deezer.download_url(link, quality, delivery.upload_limit)
+        if downloaded and not isinstance(downloaded, list):
+            self.budget.spend(os.path.getsize(downloaded[0]))
+
+    def claim(self, link):
+        """ Called before a real request downloads `link`. Cancels its
+        speculation if it hasn't started, otherwise waits for it so the
+        request finds the file in the store.
+        """
+        with self.lock:
+            future = self.futures.pop(link, None)
+        if future is None:
+            return
+        if future.cancel():
+            metrics.count("speculation_cancelled")
+            return
+        metrics.count("speculation_hits")
+        try:
+            future.result()
+        except Exception as e:
+            logger.warning("Speculative download of %s failed: %s", link, e)
@@ -0,0 +1,575 @@
+"""
+Storage backends for the bot's `music` and `download` tables.
+
+`SQLiteStorage` keeps everything in a local file and is the default.
+`PostgresStorage` lets several bot processes share one database.
+"""
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from sqlite3 import Error
+
+
+class Storage:
+    """Interface implemented by every storage backend."""
+
+    def create_music_table(self):
+        raise NotImplementedError
+
+    def alter_music_table_add_music_info(self):
+        raise NotImplementedError
+
+    def create_download_table(self):
+        raise NotImplementedError
+
+    def alter_music_table_add_quality(self):
+        raise NotImplementedError
+
+    def alter_music_table_add_requested_quality(self):
+        raise NotImplementedError
+
+    def create_quality_preference_table(self):
+        raise NotImplementedError
+
+    def create_search_table(self):
+        raise NotImplementedError
+
+    def create_playlist_snapshot_table(self):
+        raise NotImplementedError
+
+    def create_track_record(self, track):
+        raise NotImplementedError
+
+    def create_download_record(self, download_record):
+        raise NotImplementedError
+
+    def update_track_record(self, track):
+        raise NotImplementedError
+
+    def retreive_track_record(self, track):
+        raise NotImplementedError
+
+    def retreive_track_records(self, track):
+        raise NotImplementedError
+
+    def retreive_track_records_by_links(self, links):
+        raise NotImplementedError
+
+    def retreive_quality_preference(self, chat_id):
+        raise NotImplementedError
+
+    def update_quality_preference(self, chat_id, quality):
+        raise NotImplementedError
+
+    def retreive_popular_tracks(self, limit):
+        raise NotImplementedError
+
+    def retreive_download_history(self):
+        raise NotImplementedError
+
+    def search_tracks(self, query, limit):
+        raise NotImplementedError
+
+    def retreive_playlist_snapshot(self, playlist_id):
+        raise NotImplementedError
+
+    def update_playlist_snapshot(self, playlist_id, checksum, track_ids):
+        raise NotImplementedError
+
+
+def search_terms(query):
+    """The words of an inline query, each one matched as a prefix."""
+    return re.findall(r"\w+", query.lower())
+
+
+def snapshot_track_ids(text):
+    """The track ids of a playlist_snapshot row, stored comma separated."""
+    return [int(track_id) for track_id in text.split(",") if track_id]
+
+
+def search_document(track):
+    """The catalog columns of a music row, album and artist may be unknown."""
+    return {
+        "performer": track.get("performer") or "",
+        "title": track.get("title") or "",
+        "album": track.get("album") or "",
+        "artist": track.get("artist") or "",
+    }
+
+
+def create_connection(db_file):
+    """ create a database connection to the SQLite database
+        specified by db_file
+    :param db_file: database file
+    :return: Connection object or None
+    """
+    conn = None
+    try:
+        conn = sqlite3.connect(db_file, check_same_thread=False)
+        return conn
+    except Error as e:
+        print(e)
+
+    return conn
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, db_file):
+        self.conn = create_connection(db_file)
+        # the connection is shared by every thread, one transaction at a time
+        self.lock = threading.RLock()
+        # False when sqlite was built without FTS5
+        self.search_enabled = True
+
+    def create_table(self, create_table_sql):
+        """ create a table from the create_table_sql statement
+        :param create_table_sql: a CREATE TABLE statement
+        :return:
+        """
+        with self.lock, self.conn:
+            try:
+                c = self.conn.cursor()
+                c.execute(create_table_sql)
+            except Error as e:
+                print(e)
+
+    def create_music_table(self):
+        sql_create_music_table = """ CREATE TABLE IF NOT EXISTS music (
+                                            id integer PRIMARY KEY,
+                                            telegram_file_id text NOT NULL,
+                                            deezer_link text NOT NULL,
+                                            download_count integer NOT NULL,
+                                            last_downloaded text NOT NULL
+                                        ); """
+        self.create_table(sql_create_music_table)
+        with self.lock, self.conn:
+            sql = "CREATE UNIQUE INDEX IF NOT EXISTS idx_deezer_link ON music (deezer_link);"
+            cur = self.conn.cursor()
+            cur.execute(sql)
+
+    def alter_music_table_add_music_info(self):
+        with self.lock, self.conn:
+            cur = self.conn.cursor()
+            a = cur.execute("PRAGMA table_info(music);")
+            column_names = [item[1] for item in a.fetchall()]
+            if 'title' not in column_names and 'performer' not in column_names:
+                sql = "ALTER TABLE music ADD COLUMN performer;"
+                cur.execute(sql)
+                sql = "ALTER TABLE music ADD COLUMN title;"
+                cur.execute(sql)
+
+    def create_download_table(self):
+        sql_create_download_table = """ CREATE TABLE IF NOT EXISTS download (
+                                            id integer PRIMARY KEY,
+                                            telegram_id integer NOT NULL,
+                                            telegram_full_name text,
+                                            telegram_link text,
+                                            telegram_name text,
+                                            telegram_username text,
+                                            music_id integer NOT NULL,
+                                            FOREIGN KEY (music_id) REFERENCES music (id)
+                                        ); """
+        self.create_table(sql_create_download_table)
+
+    def alter_music_table_add_quality(self):
+        # the same link can be cached once per format
+        with self.lock, self.conn:
+            cur = self.conn.cursor()
+            a = cur.execute("PRAGMA table_info(music);")
+            column_names = [item[1] for item in a.fetchall()]
+            if 'quality' not in column_names:
+                cur.execute("ALTER TABLE music ADD COLUMN quality;")
+            cur.execute("DROP INDEX IF EXISTS idx_deezer_link;")
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_deezer_link_quality ON music (deezer_link, quality);")
+
+    def alter_music_table_add_requested_quality(self):
+        # the format the download asked for, quality is the one it got
+        with self.lock, self.conn:
+            cur = self.conn.cursor()
+            a = cur.execute("PRAGMA table_info(music);")
+            column_names = [item[1] for item in a.fetchall()]
+            if 'requested_quality' not in column_names:
+                cur.execute("ALTER TABLE music ADD COLUMN requested_quality;")
+
+    def create_quality_preference_table(self):
+        sql_create_quality_preference_table = """ CREATE TABLE IF NOT EXISTS quality_preference (
+                                            chat_id integer PRIMARY KEY,
+                                            quality text NOT NULL
+                                        ); """
+        self.create_table(sql_create_quality_preference_table)
+
+    def create_playlist_snapshot_table(self):
+        sql_create_playlist_snapshot_table = """ CREATE TABLE IF NOT EXISTS playlist_snapshot (
+                                            playlist_id text PRIMARY KEY,
+                                            checksum text NOT NULL,
+                                            track_ids text NOT NULL
+                                        ); """
+        self.create_table(sql_create_playlist_snapshot_table)
+
+    def create_search_table(self):
+        # music_search rowid is music.id, rows from before the catalog are
+        # added without album and artist
+        with self.lock, self.conn:
+            try:
+                cur = self.conn.cursor()
+                cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS music_search USING fts5(performer, title, album, artist);")
+                cur.execute(""" INSERT INTO music_search(rowid, performer, title, album, artist)
+                SELECT id, coalesce(performer, ''), coalesce(title, ''), '', '' FROM music
+                WHERE id NOT IN (SELECT rowid FROM music_search) """)
+            except Error as e:
+                print(e)
+                self.search_enabled = False
+
+    def create_track_record(self, track):
+        # Another delivery may have recorded the same link in the meantime,
+        # in that case its row wins and only the counter moves.
+        with self.lock, self.conn:
+            sql = """ INSERT INTO music(telegram_file_id,deezer_link,performer,title,download_count,last_downloaded,quality,requested_quality)
+            VALUES (:telegram_file_id,:deezer_link,:performer,:title,:download_count,:last_downloaded,:quality,:requested_quality)
+            ON CONFLICT (deezer_link, quality) DO UPDATE SET
+                download_count=download_count+excluded.download_count,
+                last_downloaded=excluded.last_downloaded """
+            cur = self.conn.cursor()
+            cur.execute(sql, track)
+            cur.execute("SELECT id FROM music WHERE deezer_link=:deezer_link AND quality IS :quality", track)
+            track_id = cur.fetchone()[0]
+            if self.search_enabled:
+                sql = """ INSERT INTO music_search(rowid, performer, title, album, artist)
+                SELECT :id, :performer, :title, :album, :artist
+                WHERE NOT EXISTS (SELECT 1 FROM music_search WHERE rowid=:id) """
+                cur.execute(sql, dict(search_document(track), id=track_id))
+            return track_id
+
+    def create_download_record(self, download_record):
+        with self.lock, self.conn:
+            sql = """ INSERT INTO download(telegram_id, telegram_full_name, telegram_link, telegram_name, telegram_username, music_id)
+            VALUES (:telegram_id, :telegram_full_name, :telegram_link, :telegram_name, :telegram_username, :music_id) """
+            cur = self.conn.cursor()
+            cur.execute(sql, download_record)
+            return cur.lastrowid
+
+    def update_track_record(self, track):
+        with self.lock, self.conn:
+            sql = "UPDATE music SET download_count=download_count+1,last_downloaded=:last_downloaded, performer=:performer, title=:title WHERE deezer_link=:deezer_link AND quality IS :quality "
+            cur = self.conn.cursor()
+            cur.execute(sql, track)
+            if self.search_enabled:
+                sql = """ UPDATE music_search SET performer=:performer, title=:title
+                WHERE rowid IN (SELECT id FROM music WHERE deezer_link=:deezer_link AND quality IS :quality) """
+                cur.execute(sql, dict(search_document(track), deezer_link=track["deezer_link"], quality=track["quality"]))
+
+    def retreive_track_record(self, track):
+        with self.lock, self.conn:
+            sql = "SELECT * from music WHERE deezer_link=:deezer_link "
+            cur = self.conn.cursor()
+            cur.execute(sql, track)
+            return cur.fetchone()
+
+    def retreive_track_records(self, track):
+        with self.lock, self.conn:
+            sql = "SELECT * from music WHERE deezer_link=:deezer_link "
+            cur = self.conn.cursor()
+            cur.execute(sql, track)
+            return cur.fetchall()
+
+    def retreive_track_records_by_links(self, links):
+        if not links:
+            return []
+        with self.lock, self.conn:
+            params = {f"link{i}": link for i, link in enumerate(links)}
+            sql = "SELECT * from music WHERE deezer_link IN ({}) ".format(
+                ",".join(f":{name}" for name in params)
+            )
+            cur = self.conn.cursor()
+            cur.execute(sql, params)
+            return cur.fetchall()
+
+    def retreive_quality_preference(self, chat_id):
+        with self.lock, self.conn:
+            sql = "SELECT quality from quality_preference WHERE chat_id=:chat_id "
+            cur = self.conn.cursor()
+            cur.execute(sql, {"chat_id": chat_id})
+            row = cur.fetchone()
+            return row[0] if row else None
+
+    def update_quality_preference(self, chat_id, quality):
+        with self.lock, self.conn:
+            sql = "INSERT OR REPLACE INTO quality_preference(chat_id, quality) VALUES (:chat_id, :quality) "
+            cur = self.conn.cursor()
+            cur.execute(sql, {"chat_id": chat_id, "quality": quality})
+
+    def retreive_playlist_snapshot(self, playlist_id):
+        with self.lock, self.conn:
+            sql = "SELECT checksum, track_ids from playlist_snapshot WHERE playlist_id=:playlist_id "
+            cur = self.conn.cursor()
+            cur.execute(sql, {"playlist_id": str(playlist_id)})
+            row = cur.fetchone()
+            return (row[0], snapshot_track_ids(row[1])) if row else None
+
+    def update_playlist_snapshot(self, playlist_id, checksum, track_ids):
+        with self.lock, self.conn:
+            sql = """ INSERT OR REPLACE INTO playlist_snapshot(playlist_id, checksum, track_ids)
+            VALUES (:playlist_id, :checksum, :track_ids) """
+            cur = self.conn.cursor()
+            cur.execute(sql, {
+                "playlist_id": str(playlist_id),
+                "checksum": checksum,
+                "track_ids": ",".join(str(track_id) for track_id in track_ids),
+            })
+
+    def retreive_popular_tracks(self, limit):
+        with self.lock, self.conn:
+            sql = "SELECT deezer_link from music ORDER BY download_count DESC, last_downloaded DESC LIMIT :limit "
+            cur = self.conn.cursor()
+            cur.execute(sql, {"limit": limit})
+            return [row[0] for row in cur.fetchall()]
+
+    def retreive_download_history(self):
+        with self.lock, self.conn:
+            sql = "SELECT * from download"
+            cur = self.conn.cursor()
+            cur.execute(sql)
+            return cur.fetchall()
+
+    def search_tracks(self, query, limit):
+        terms = search_terms(query)
+        if not self.search_enabled or not terms:
+            return []
+        match = " ".join('"{}"*'.format(term) for term in terms)
+        with self.lock, self.conn:
+            sql = """ SELECT music.id, music.telegram_file_id, music.deezer_link, music.download_count,
+                music_search.performer, music_search.title, music_search.album, music_search.artist
+            FROM music_search JOIN music ON music.id = music_search.rowid
+            WHERE music_search MATCH :match
+            ORDER BY music.download_count DESC, music_search.rank LIMIT :limit """
+            cur = self.conn.cursor()
+            cur.execute(sql, {"match": match, "limit": limit})
+            return cur.fetchall()
+
+
+class PostgresStorage(Storage):
+    """ Shares the tables between bot instances through PostgreSQL.
+    Connections come from a thread safe pool, so handlers running in
+    different dispatcher threads don't block each other.
+    """
+
+    def __init__(self, dsn, min_connections=1, max_connections=10):
+        from psycopg2.pool import ThreadedConnectionPool
+
+        self.pool = ThreadedConnectionPool(min_connections, max_connections, dsn)
+        # the pool raises once it is exhausted, further threads wait here
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    @contextmanager
+    def cursor(self):
+        with self.slots:
+            conn = self.pool.getconn()
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        yield cur
+            finally:
+                self.pool.putconn(conn)
+
+    def create_music_table(self):
+        with self.cursor() as cur:
+            cur.execute(
+                """ CREATE TABLE IF NOT EXISTS music (
+                        id serial PRIMARY KEY,
+                        telegram_file_id text NOT NULL,
+                        deezer_link text NOT NULL,
+                        download_count integer NOT NULL,
+                        last_downloaded text NOT NULL,
+                        performer text,
+                        title text,
+                        quality text
+                    ); """
+            )
+            cur.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_deezer_link ON music (deezer_link);"
+            )
+
+    def alter_music_table_add_music_info(self):
+        with self.cursor() as cur:
+            cur.execute("ALTER TABLE music ADD COLUMN IF NOT EXISTS performer text;")
+            cur.execute("ALTER TABLE music ADD COLUMN IF NOT EXISTS title text;")
+
+    def alter_music_table_add_quality(self):
+        with self.cursor() as cur:
+            cur.execute("ALTER TABLE music ADD COLUMN IF NOT EXISTS quality text;")
+            cur.execute("DROP INDEX IF EXISTS idx_deezer_link;")
+            cur.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS idx_deezer_link_quality ON music (deezer_link, quality);"
+            )
+
+    def alter_music_table_add_requested_quality(self):
+        with self.cursor() as cur:
+            cur.execute("ALTER TABLE music ADD COLUMN IF NOT EXISTS requested_quality text;")
+
+    def create_quality_preference_table(self):
+        with self.cursor() as cur:
+            cur.execute(
+                """ CREATE TABLE IF NOT EXISTS quality_preference (
+                        chat_id bigint PRIMARY KEY,
+                        quality text NOT NULL
+                    ); """
+            )
+
+    def create_playlist_snapshot_table(self):
+        with self.cursor() as cur:
+            cur.execute(
+                """ CREATE TABLE IF NOT EXISTS playlist_snapshot (
+                        playlist_id text PRIMARY KEY,
+                        checksum text NOT NULL,
+                        track_ids text NOT NULL
+                    ); """
+            )
+
+    def create_search_table(self):
+        with self.cursor() as cur:
+            cur.execute(
+                """ CREATE TABLE IF NOT EXISTS music_search (
+                        music_id integer PRIMARY KEY REFERENCES music (id),
+                        performer text,
+                        title text,
+                        album text,
+                        artist text,
+                        document tsvector NOT NULL
+                    ); """
+            )
+            cur.execute(
+                "CREATE INDEX IF NOT EXISTS idx_music_search ON music_search USING GIN (document);"
+            )
+            cur.execute(
+                """ INSERT INTO music_search(music_id, performer, title, album, artist, document)
+                SELECT id, coalesce(performer, ''), coalesce(title, ''), '', '',
+                    to_tsvector('simple', coalesce(performer, '') || ' ' || coalesce(title, ''))
+                FROM music ON CONFLICT (music_id) DO NOTHING """
+            )
+
+    def create_download_table(self):
+        with self.cursor() as cur:
+            cur.execute(
+                """ CREATE TABLE IF NOT EXISTS download (
+                        id serial PRIMARY KEY,
+                        telegram_id bigint NOT NULL,
+                        telegram_full_name text,
+                        telegram_link text,
+                        telegram_name text,
+                        telegram_username text,
+                        music_id integer NOT NULL REFERENCES music (id)
+                    ); """
+            )
+
+    def create_track_record(self, track):
+        # Another instance may have uploaded the same link in the meantime,
+        # in that case its row wins and only the counter moves.
+        with self.cursor() as cur:
+            sql = """ INSERT INTO music(telegram_file_id,deezer_link,performer,title,download_count,last_downloaded,quality,requested_quality)
+            VALUES (%(telegram_file_id)s,%(deezer_link)s,%(performer)s,%(title)s,%(download_count)s,%(last_downloaded)s,%(quality)s,%(requested_quality)s)
+            ON CONFLICT (deezer_link, quality) DO UPDATE SET
+                download_count=music.download_count+EXCLUDED.download_count,
+                last_downloaded=EXCLUDED.last_downloaded
+            RETURNING id """
+            cur.execute(sql, track)
+            track_id = cur.fetchone()[0]
+            sql = """ INSERT INTO music_search(music_id, performer, title, album, artist, document)
+            VALUES (%(id)s, %(performer)s, %(title)s, %(album)s, %(artist)s,
+                to_tsvector('simple', %(performer)s || ' ' || %(title)s || ' ' || %(album)s || ' ' || %(artist)s))
+            ON CONFLICT (music_id) DO NOTHING """
+            cur.execute(sql, dict(search_document(track), id=track_id))
+            return track_id
+
+    def create_download_record(self, download_record):
+        with self.cursor() as cur:
+            sql = """ INSERT INTO download(telegram_id, telegram_full_name, telegram_link, telegram_name, telegram_username, music_id)
+            VALUES (%(telegram_id)s, %(telegram_full_name)s, %(telegram_link)s, %(telegram_name)s, %(telegram_username)s, %(music_id)s)
+            RETURNING id """
+            cur.execute(sql, download_record)
+            return cur.fetchone()[0]
+
+    def update_track_record(self, track):
+        with self.cursor() as cur:
+            sql = "UPDATE music SET download_count=download_count+1,last_downloaded=%(last_downloaded)s, performer=%(performer)s, title=%(title)s WHERE deezer_link=%(deezer_link)s AND quality IS NOT DISTINCT FROM %(quality)s "
+            cur.execute(sql, track)
+            sql = """ UPDATE music_search SET performer=%(performer)s, title=%(title)s,
+                document=to_tsvector('simple', %(performer)s || ' ' || %(title)s || ' ' || album || ' ' || artist)
+            WHERE music_id IN (SELECT id FROM music WHERE deezer_link=%(deezer_link)s AND quality IS NOT DISTINCT FROM %(quality)s) """
+            cur.execute(sql, dict(search_document(track), deezer_link=track["deezer_link"], quality=track["quality"]))
+
+    def retreive_track_record(self, track):
+        with self.cursor() as cur:
+            sql = "SELECT id, telegram_file_id, deezer_link, download_count, last_downloaded, performer, title, quality, requested_quality from music WHERE deezer_link=%(deezer_link)s "
+            cur.execute(sql, track)
+            return cur.fetchone()
+
+    def retreive_track_records(self, track):
+        with self.cursor() as cur:
+            sql = "SELECT id, telegram_file_id, deezer_link, download_count, last_downloaded, performer, title, quality, requested_quality from music WHERE deezer_link=%(deezer_link)s "
+            cur.execute(sql, track)
+            return cur.fetchall()
+
+    def retreive_track_records_by_links(self, links):
+        if not links:
+            return []
+        with self.cursor() as cur:
+            sql = "SELECT id, telegram_file_id, deezer_link, download_count, last_downloaded, performer, title, quality, requested_quality from music WHERE deezer_link = ANY(%(links)s) "
+            cur.execute(sql, {"links": list(links)})
+            return cur.fetchall()
+
+    def retreive_quality_preference(self, chat_id):
+        with self.cursor() as cur:
+            sql = "SELECT quality from quality_preference WHERE chat_id=%(chat_id)s "
+            cur.execute(sql, {"chat_id": chat_id})
+            row = cur.fetchone()
+            return row[0] if row else None
+
+    def update_quality_preference(self, chat_id, quality):
+        with self.cursor() as cur:
+            sql = """ INSERT INTO quality_preference(chat_id, quality) VALUES (%(chat_id)s, %(quality)s)
+            ON CONFLICT (chat_id) DO UPDATE SET quality=EXCLUDED.quality """
+            cur.execute(sql, {"chat_id": chat_id, "quality": quality})
+
+    def retreive_playlist_snapshot(self, playlist_id):
+        with self.cursor() as cur:
+            sql = "SELECT checksum, track_ids from playlist_snapshot WHERE playlist_id=%(playlist_id)s "
+            cur.execute(sql, {"playlist_id": str(playlist_id)})
+            row = cur.fetchone()
+            return (row[0], snapshot_track_ids(row[1])) if row else None
+
+    def update_playlist_snapshot(self, playlist_id, checksum, track_ids):
+        with self.cursor() as cur:
+            sql = """ INSERT INTO playlist_snapshot(playlist_id, checksum, track_ids)
+            VALUES (%(playlist_id)s, %(checksum)s, %(track_ids)s)
+            ON CONFLICT (playlist_id) DO UPDATE SET checksum=EXCLUDED.checksum, track_ids=EXCLUDED.track_ids """
+            cur.execute(sql, {
+                "playlist_id": str(playlist_id),
+                "checksum": checksum,
+                "track_ids": ",".join(str(track_id) for track_id in track_ids),
+            })
+
+    def retreive_popular_tracks(self, limit):
+        with self.cursor() as cur:
+            sql = "SELECT deezer_link from music ORDER BY download_count DESC, last_downloaded DESC LIMIT %(limit)s "
+            cur.execute(sql, {"limit": limit})
+            return [row[0] for row in cur.fetchall()]
+
+    def retreive_download_history(self):
+        with self.cursor() as cur:
+            cur.execute("SELECT * from download")
+            return cur.fetchall()
+
+    def search_tracks(self, query, limit):
+        terms = search_terms(query)
+        if not terms:
+            return []
+        with self.cursor() as cur:
+            sql = """ SELECT music.id, music.telegram_file_id, music.deezer_link, music.download_count,
+                music_search.performer, music_search.title, music_search.album, music_search.artist
+            FROM music_search JOIN music ON music.id = music_search.music_id
+            WHERE music_search.document @@ to_tsquery('simple', %(match)s)
+            ORDER BY music.download_count DESC LIMIT %(limit)s """
+            match = " & ".join(f"{term}:*" for term in terms)
+            cur.execute(sql, {"match": match, "limit": limit})
+            return cur.fetchall()
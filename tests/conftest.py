@@ -0,0 +1,60 @@
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+# the bot's modules live in the repository root, the stand-in servers
+# next to the benchmarks
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+from mock_servers import MockDeezer  # noqa: E402
+
+
+@pytest.fixture
+def deezer_server():
+    server = MockDeezer(tracks_per_album=3, albums_per_artist=2, track_bytes=64 * 1024).start()
+    yield server
+    server.stop()
+
+
+def write_deezpyrc(home, tokens="mock", quality=2):
+    downloads = home / "downloads"
+    (home / ".config").mkdir(exist_ok=True)
+    (home / ".config" / "deezpyrc").write_text(
+        "[DEFAULT]\n"
+        f"userTokens = {tokens}\n"
+        f"quality = {quality}\n"
+        f"naming template = {downloads}/<Album Artist>/<Album>/<Track#> - <Title>\n"
+        f"playlist naming template = {downloads}/<Playlist Title>/<Track#> - <Title>\n"
+        f"store folder = {home / 'store'}\n"
+        "embed album art = True\n"
+        "download lyrics = True\n"
+    )
+
+
+@pytest.fixture
+def deezpy_env(tmp_path, deezer_server, monkeypatch):
+    """ deezpy pointed at `deezer_server`, with its settings, store and
+    downloads in tmp_path and none of the state an earlier test left.
+    Call deezpy_env.deezpy.init() after changing the settings.
+    """
+    import deezpy
+
+    write_deezpyrc(tmp_path)
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(deezpy, "config", None)
+    monkeypatch.setattr(deezpy, "accounts", [])
+    monkeypatch.setattr(deezpy, "lyricsFutures", {})
+    monkeypatch.setattr(deezpy, "coverFutures", {})
+    monkeypatch.setattr(deezpy, "cdnTtfb", {})
+    monkeypatch.setattr(deezpy, "cdnThroughput", {})
+    monkeypatch.setattr(deezpy, "cdnStalledUntil", {})
+    monkeypatch.setattr(deezpy, "apiUrl", deezer_server.url)
+    monkeypatch.setattr(deezpy, "gwUrl", f"{deezer_server.url}/ajax/gw-light.php")
+    monkeypatch.setattr(deezpy, "imageUrl", f"{deezer_server.url}/images/cover")
+    monkeypatch.setattr(deezpy, "cdnUrl", deezer_server.url + "/cdn-{}")
+    monkeypatch.chdir(tmp_path)
+    return SimpleNamespace(deezpy=deezpy, home=tmp_path, server=deezer_server)
@@ -0,0 +1,93 @@
+"""deezpy's account pool against two mock ARLs, one of which gets throttled."""
+import time
+
+import pytest
+
+import metrics
+from conftest import write_deezpyrc
+
+
+def counter(name):
+    return metrics.snapshot()[1].get(name, 0)
+
+
+@pytest.fixture
+def pool(deezpy_env, monkeypatch):
+    deezpy = deezpy_env.deezpy
+    write_deezpyrc(deezpy_env.home, tokens="a,b")
+    monkeypatch.setattr(deezpy, "throttleBackoff", 0.2)
+    deezpy.init()
+    first, second = deezpy.accounts
+    assert (first["name"], second["name"]) == ("1", "2")
+    return deezpy, first, second
+
+
+def test_traffic_moves_to_the_healthy_account(deezpy_env, pool):
+    deezpy, first, second = pool
+    server = deezpy_env.server
+    server.throttled_arls.add("a")
+    throttled = counter("account_1_throttled")
+    requests = counter("account_2_requests")
+
+    for _ in range(4):
+        assert "100101" in deezpy.privateApiBatch([100101])
+    assert counter("account_1_throttled") == throttled + 1
+    assert counter("account_2_requests") >= requests + 4
+    assert first["throttledUntil"] > time.monotonic()
+
+    # a download picks the healthy account from the start
+    calls = server.gw_calls["a"]
+    stored, _ = deezpy.downloadDeezer("https://www.deezer.com/track/100102", templateLinks=False)
+    assert stored
+    assert server.gw_calls["a"] == calls
+    assert second["active"] == 0
+
+
+def test_backoff_doubles_and_resets(deezpy_env, pool):
+    deezpy, first, second = pool
+    deezpy_env.server.throttled_arls.add("a")
+    deezpy.throttleAccount(first)
+    assert deezpy.pickAccount() is second
+
+    # still throttled once the back off ends, it backs off twice as long
+    time.sleep(0.25)
+    deezpy.currentAccount.account = first
+    first["active"] += 1
+    try:
+        deezpy.privateApiBatch([100101])
+        assert deezpy.currentAccount.account is second
+    finally:
+        deezpy.currentAccount.account["active"] -= 1
+        deezpy.currentAccount.account = None
+    assert first["throttles"] == 2
+    assert first["throttledUntil"] - time.monotonic() > 0.2
+
+    # with every account throttled, the one whose back off ends first
+    deezpy.throttleAccount(second)
+    assert deezpy.pickAccount() is second
+
+    # a successful call ends the run of throttles
+    deezpy_env.server.throttled_arls.clear()
+    first["throttledUntil"] = second["throttledUntil"] = 0
+    deezpy.currentAccount.account = first
+    try:
+        deezpy.privateApiBatch([100101])
+    finally:
+        deezpy.currentAccount.account = None
+    assert first["throttles"] == 0
+
+
+def test_expired_csrf_token_logs_in_again(deezpy_env, pool):
+    deezpy, first, second = pool
+    server = deezpy_env.server
+    first["CSRFToken"] = second["CSRFToken"] = "expired"
+    logins = server.calls["deezer.getUserData"]
+    errors = counter("account_1_errors") + counter("account_2_errors")
+
+    assert "100101" in deezpy.privateApiBatch([100101])
+    assert server.calls["deezer.getUserData"] == logins + 1
+    assert counter("account_1_errors") + counter("account_2_errors") == errors + 1
+    # the call ran on the least picked account, which kept it
+    assert first["CSRFToken"] == "csrf-a"
+    assert second["CSRFToken"] == "expired"
+    assert first["throttledUntil"] == 0
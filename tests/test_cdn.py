@@ -0,0 +1,75 @@
+"""deezpy's CDN hedging and failover against slow, stalling and Range ignoring mock hosts."""
+import hashlib
+import os
+import time
+
+import pytest
+
+import metrics
+
+TRACK = 100101
+
+
+def home(track_id):
+    return hashlib.md5(str(track_id).encode()).hexdigest()[0]
+
+
+def counter(name):
+    return metrics.snapshot()[1].get(name, 0)
+
+
+@pytest.fixture
+def cdn(deezpy_env, monkeypatch):
+    deezpy = deezpy_env.deezpy
+    monkeypatch.setattr(deezpy, "hedgeDefaultDelay", 0.2)
+    monkeypatch.setattr(deezpy, "stallTimeout", 0.5)
+    deezpy.init()
+    return deezpy, deezpy_env.server
+
+
+def download(deezpy, track_id=TRACK):
+    stored, _ = deezpy.downloadDeezer(f"https://www.deezer.com/track/{track_id}", templateLinks=False)
+    with open(stored, "rb") as f:
+        data = f.read()
+    os.remove(stored)
+    return data
+
+
+def test_slow_host_is_hedged(cdn):
+    deezpy, server = cdn
+    expected = download(deezpy)
+    server.cdn_latency[home(TRACK)] = 3
+    hedges = counter("cdn_hedges")
+    started = time.perf_counter()
+    assert download(deezpy) == expected
+    assert time.perf_counter() - started < 2
+    assert counter("cdn_hedges") == hedges + 1
+
+
+def test_stalled_stream_resumes_on_another_host(cdn):
+    deezpy, server = cdn
+    expected = download(deezpy)
+    server.cdn_songs.clear()
+    server.cdn_stall[home(TRACK)] = (server.track_bytes // 2, 5)
+    stalls = counter("cdn_stalls")
+    assert download(deezpy) == expected
+    assert counter("cdn_stalls") == stalls + 1
+    assert server.cdn_songs[TRACK] == 2
+
+
+def test_host_ignoring_range_is_failed_over(cdn):
+    deezpy, server = cdn
+    expected = download(deezpy)
+    server.cdn_songs.clear()
+    # the stream stalls half way, and every other host but one answers
+    # the Range request with the whole file
+    healthy = next(host for host in deezpy.cdnHosts if host != home(TRACK))
+    server.cdn_stall[home(TRACK)] = (server.track_bytes // 2, 5)
+    server.cdn_ignore_range.update(
+        host for host in deezpy.cdnHosts if host not in (home(TRACK), healthy)
+    )
+    # measured hosts rank before the others, so one of them is asked first
+    deezpy.cdnThroughput.update((host, 1e6) for host in server.cdn_ignore_range)
+    assert download(deezpy) == expected
+    # the home host, the hosts that answered 200 and the healthy one
+    assert server.cdn_songs[TRACK] > 2
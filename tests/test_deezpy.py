@@ -0,0 +1,62 @@
+"""deezpy's download pipeline against benchmarks/mock_servers.py."""
+import os
+
+
+def test_album_lyrics_in_a_fresh_folder(deezpy_env):
+    deezpy = deezpy_env.deezpy
+    deezpy.init()
+    names = deezpy.downloadDeezer("https://www.deezer.com/album/1001")
+    assert len(names) == 3
+    for path, quality in names:
+        assert quality == "MP3_320"
+        lyrics = f"{os.path.splitext(path)[0]}.txt"
+        with open(lyrics) as f:
+            assert f.read() == "Mock lyrics\nline two\n"
+    assert os.path.isfile(os.path.join(os.path.dirname(names[0][0]), "cover.png"))
+
+
+def test_store_keeps_lyrics_and_no_cover(deezpy_env):
+    deezpy = deezpy_env.deezpy
+    deezpy.init()
+    stored, _ = deezpy.downloadDeezer("https://www.deezer.com/track/100101", templateLinks=False)
+    assert stored.startswith(str(deezpy_env.home / "store"))
+    assert os.path.isfile(f"{os.path.splitext(stored)[0]}.txt")
+    assert not os.path.exists(os.path.join(os.path.dirname(stored), "cover.png"))
+    assert not os.path.exists(deezpy_env.home / "downloads")
+
+    # a later route finds the track and its lyrics in the store
+    path, _ = deezpy.downloadDeezer("https://www.deezer.com/track/100101")
+    assert os.path.samefile(path, stored)
+    assert os.path.isfile(f"{os.path.splitext(path)[0]}.txt")
+
+
+def test_store_tags_the_contributors(deezpy_env):
+    import mutagen
+
+    deezpy = deezpy_env.deezpy
+    deezpy.init()
+    stored, _ = deezpy.downloadDeezer("https://www.deezer.com/track/100101", templateLinks=False)
+    assert mutagen.File(stored, easy=True)["artist"] == ["Mock Artist 1"]
+
+
+def test_playlist_header_without_its_tracks(deezpy_env, monkeypatch):
+    import mutagen
+
+    deezpy = deezpy_env.deezpy
+    urls = []
+    getURL = deezpy.getURL
+
+    def recordURL(url):
+        urls.append(url)
+        return getURL(url)
+
+    monkeypatch.setattr(deezpy, "getURL", recordURL)
+    deezpy.init()
+    deezpy.downloadDeezer("https://www.deezer.com/playlist/5")
+    assert not [url for url in urls if url.split("?")[0].endswith("/playlist/5")]
+    assert deezpy_env.server.calls["playlist.getData"] == 1
+
+    path = deezpy_env.home / "downloads" / "Mock Playlist 5" / "01 - Mock Track 100101.mp3"
+    tags = mutagen.File(path, easy=True)
+    assert tags["album"] == ["Mock Playlist 5"]
+    assert tags["tracknumber"] == ["1/6"]
@@ -0,0 +1,67 @@
+"""delivery against the deezer and Bot API stand-ins of benchmarks/mock_servers.py."""
+import pytest
+
+import db_handler
+import delivery
+from deezer_handler import DeezerHandler
+from mock_servers import FakeBotApi
+from storage import SQLiteStorage
+
+CHAT_ID = 4242
+USER = {
+    "telegram_full_name": "Test User",
+    "telegram_id": CHAT_ID,
+    "telegram_link": "https://t.me/test_user",
+    "telegram_name": "@test_user",
+    "telegram_username": "test_user",
+}
+
+
+@pytest.fixture
+def bot_api():
+    server = FakeBotApi().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def bot(deezpy_env, bot_api, tmp_path, monkeypatch):
+    monkeypatch.setattr(db_handler, "storage", SQLiteStorage(str(tmp_path / "test.db")))
+    db_handler.create_tables()
+    deezpy_env.deezpy.init()
+    return delivery.create_bot({"TELEGRAM_TOKEN": "123456:mock", "BOT_API_URL": f"{bot_api.url}/bot"})
+
+
+def test_playlist_downloads_only_the_added_tracks(deezpy_env, bot_api, bot):
+    server = deezpy_env.server
+    link = "https://www.deezer.com/playlist/5"
+
+    delivery.deliver_playlist(bot, DeezerHandler(), CHAT_ID, link, USER)
+    assert set(server.cdn_songs) == {100101, 100102, 100103, 100201, 100202, 100203}
+    assert server.calls["song.getListData"] == 1
+    assert bot_api.calls["sendAudio"] == 6
+
+    server.cdn_songs.clear()
+    server.playlist_added[5] = [200101, 200102]
+    delivery.deliver_playlist(bot, DeezerHandler(), CHAT_ID, link, USER)
+    assert set(server.cdn_songs) == {200101, 200102}
+    assert server.calls["song.getListData"] == 2
+    # the summary is the only message of each delivery
+    assert bot_api.calls["sendMessage"] == 2
+    assert bot_api.calls["sendMediaGroup"] == 1
+    assert bot_api.calls["sendAudio"] == 8
+    rows = db_handler.storage.retreive_track_records(
+        {"deezer_link": "https://www.deezer.com/track/200102"}
+    )
+    assert [(row[5], row[6]) for row in rows] == [("Mock Artist 2", "Mock Track 200102")]
+
+
+def test_playlist_snapshot_skips_the_track_list(deezpy_env, bot_api, bot):
+    server = deezpy_env.server
+    link = "https://www.deezer.com/playlist/5"
+    delivery.deliver_playlist(bot, DeezerHandler(), CHAT_ID, link, USER)
+    pages = server.calls["playlist"]
+    delivery.deliver_playlist(bot, DeezerHandler(), CHAT_ID, link, USER)
+    # only the one track page that carries the checksum
+    assert server.calls["playlist"] == pages + 1
+    assert server.calls["song.getListData"] == 1
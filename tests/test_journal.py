@@ -0,0 +1,48 @@
+import time
+
+from journal import Journal
+
+USER = {"telegram_id": 42}
+
+
+def open_journal(tmp_path, **options):
+    return Journal(str(tmp_path / "journal.db"), flush_interval=60, **options)
+
+
+def test_unfinished_jobs_survive_a_crash_before_they_resume(tmp_path):
+    journal = open_journal(tmp_path)
+    journal.update(journal.start(42, "https://www.deezer.com/track/1", USER), "downloading")
+    journal.close()
+
+    # the next run reads the job and dies before journaling it again
+    journal = open_journal(tmp_path)
+    assert [job["state"] for job in journal.unfinished()] == ["downloading"]
+    journal.close()
+
+    journal = open_journal(tmp_path)
+    (job,) = journal.unfinished()
+    assert job["state"] == "resuming"
+    job_id = journal.start(job["chat_id"], job["link"], job["user"], job["attempts"] + 1, replaces=job["id"])
+    journal.close()
+
+    journal = open_journal(tmp_path)
+    (resumed,) = journal.unfinished()
+    assert (resumed["id"], resumed["attempts"], resumed["user"]) == (job_id, 1, USER)
+    journal.close()
+
+
+def test_failed_jobs_are_swept(tmp_path):
+    journal = open_journal(tmp_path, failed_ttl=0.1)
+    journal.start(42, "https://www.deezer.com/track/1", USER)
+    journal.close()
+
+    journal = open_journal(tmp_path, failed_ttl=0.1)
+    (job,) = journal.unfinished()
+    journal.give_up(job)
+    journal.flush()
+    assert journal.unfinished() == []
+    assert journal.conn.execute("SELECT state FROM journal").fetchall() == [("failed",)]
+    time.sleep(0.2)
+    journal.sweep()
+    assert journal.conn.execute("SELECT state FROM journal").fetchall() == []
+    journal.close()
@@ -0,0 +1,28 @@
+import pytest
+
+import db_handler
+from speculator import Speculator
+from storage import SQLiteStorage
+
+LINK = "https://www.deezer.com/track/100101"
+
+
+@pytest.fixture
+def speculator(deezpy_env, tmp_path, monkeypatch):
+    monkeypatch.setattr(db_handler, "storage", SQLiteStorage(str(tmp_path / "test.db")))
+    db_handler.create_tables()
+    speculator = Speculator(lambda: 0, {"SPECULATE_BANDWIDTH_MB": 1})
+    yield speculator
+    speculator.executor.shutdown()
+
+
+def test_only_downloads_are_charged(deezpy_env, speculator):
+    left = speculator.budget.left()
+    speculator.download(LINK, "MP3_320")
+    charged = left - speculator.budget.left()
+    assert charged > deezpy_env.server.track_bytes
+
+    served = deezpy_env.server.served_bytes
+    speculator.download(LINK, "MP3_320")
+    assert left - speculator.budget.left() == charged
+    assert deezpy_env.server.served_bytes == served
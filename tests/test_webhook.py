@@ -0,0 +1,33 @@
+import queue
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+from webhook import WebhookServer
+
+
+@pytest.fixture
+def webhook():
+    dispatcher = SimpleNamespace(bot=None)
+    server = WebhookServer(dispatcher, "127.0.0.1", 0, "/hook", workers=0)
+    server.start()
+    yield server, f"http://127.0.0.1:{server.httpd.server_address[1]}/hook"
+    server.stop()
+
+
+@pytest.mark.parametrize(
+    "body", [b"not json", b"[]", b"1", b'"x"', b"null", b'{"update_id": 1, "message": 5}']
+)
+def test_malformed_bodies_are_refused(webhook, body):
+    server, url = webhook
+    assert requests.post(url, data=body).status_code == 400
+    assert server.queue_depth() == 0
+
+
+def test_update_is_queued(webhook):
+    server, url = webhook
+    assert requests.post(url, json={"update_id": 1}).status_code == 200
+    assert server.updates.get_nowait().update_id == 1
+    with pytest.raises(queue.Empty):
+        server.updates.get_nowait()
@@ -0,0 +1,92 @@
+"""
+Process wide store of the deezer tracks shown in inline results.
+
+inlinequery fetches the full track of every result so get_link can tag
+the upload without asking deezer again. Only the few fields delivery needs
+are kept, in `TrackInfo` records, and the store evicts the least recently
+used ones once it holds more than `max_bytes`, so memory stays flat however
+many users search.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+# bytes an OrderedDict entry costs on top of its key and value
+ENTRY_OVERHEAD = 100
+
+
+class TrackInfo:
+    """The fields of a deezer Track that delivery uses."""
+
+    __slots__ = ("title", "performers", "cover", "artist", "album")
+
+    def __init__(self, title, performers, cover, artist, album):
+        self.title = title
+        self.performers = performers
+        self.cover = cover
+        self.artist = artist
+        self.album = album
+
+    def size(self):
+        return sys.getsizeof(self) + sum(
+            sys.getsizeof(getattr(self, name)) for name in self.__slots__
+        )
+
+
+def track_performers(song):
+    """Joins the names of all contributors of a deezer track."""
+    authors = []
+    for author in song.contributors:
+        authors.append(author["name"])
+    return ", ".join(authors)
+
+
+def track_info(song):
+    """TrackInfo of a full deezer Track, as returned by get_full_track()."""
+    return TrackInfo(
+        song.title,
+        track_performers(song),
+        song.album.cover_medium,
+        song.artist.name,
+        song.album.title,
+    )
+
+
+class TrackStore:
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.records = OrderedDict()
+        self.bytes = 0
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, track_id):
+        track_id = int(track_id)
+        with self.lock:
+            record = self.records.get(track_id)
+            if record is not None:
+                self.records.move_to_end(track_id)
+            return record
+
+    def put(self, track_id, record):
+        track_id = int(track_id)
+        size = record.size() + sys.getsizeof(track_id) + ENTRY_OVERHEAD
+        with self.lock:
+            old = self.records.pop(track_id, None)
+            if old is not None:
+                self.bytes -= old.size() + sys.getsizeof(track_id) + ENTRY_OVERHEAD
+            self.records[track_id] = record
+            self.bytes += size
+            while self.bytes > self.max_bytes and len(self.records) > 1:
+                evicted_id, evicted = self.records.popitem(last=False)
+                self.bytes -= evicted.size() + sys.getsizeof(evicted_id) + ENTRY_OVERHEAD
+
+    def memory_bytes(self):
+        """Approximate memory held by the records."""
+        return self.bytes
+
+
+# the store shared by every handler, main() sets its size from config.json
+tracks = TrackStore()
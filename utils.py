@@ -1,5 +1,6 @@
 
 from datetime import datetime
+import json
 import pytz
 
 
@@ -7,3 +8,12 @@ def timezone_time(time):
     tehran = pytz.timezone("Asia/Tehran")
     fmt = '%Y-%m-%d %H:%M:%S'
     return tehran.localize(time).strftime(fmt)
+
+
+def local_now():
+    return datetime.now(pytz.timezone("Asia/Tehran"))
+
+
+def load_config():
+    with open('config.json') as json_config_file:
+        return json.load(json_config_file)
@@ -0,0 +1,88 @@
+"""
+Webhook mode: Telegram posts updates to a small HTTP server instead of the
+bot long polling getUpdates.
+
+Every update is decoded, put on a bounded queue and answered with 200 right
+away. A fixed pool of threads feeds the queue into the dispatcher, which
+bounds how many updates are handled at once. When the queue is full the
+server answers 503 and Telegram retries the update later.
+"""
+import json
+import logging
+import queue
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    def __init__(self, dispatcher, listen, port, path, workers=4, max_queue=100):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.updates = queue.Queue(maxsize=max_queue)
+        self.workers = [
+            threading.Thread(target=self.process_updates, daemon=True)
+            for _ in range(workers)
+        ]
+        self.httpd = ThreadingHTTPServer((listen, port), self.request_handler())
+        self.httpd.daemon_threads = True
+
+    def request_handler(self):
+        server = self
+
+        class WebhookHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.path:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                length = int(self.headers.get("Content-Length", 0))
+                try:
+                    data = json.loads(self.rfile.read(length))
+                    if not isinstance(data, dict):
+                        raise ValueError("an update is a JSON object")
+                    update = Update.de_json(data, server.dispatcher.bot)
+                except (ValueError, TypeError, KeyError, AttributeError):
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                try:
+                    server.updates.put_nowait(update)
+                except queue.Full:
+                    self.send_response(503)
+                    self.send_header("Retry-After", "1")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return WebhookHandler
+
+    def process_updates(self):
+        while True:
+            update = self.updates.get()
+            try:
+                self.dispatcher.process_update(update)
+            except Exception as e:
+                logger.warning('Update "%s" caused error "%s"', update, e)
+            finally:
+                self.updates.task_done()
+
+    def queue_depth(self):
+        return self.updates.qsize()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        logger.info("Webhook listening on %s:%d%s", *self.httpd.server_address[:2], self.path)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,109 @@
+"""
+Download worker for DOWNLOAD_MODE "broker".
+
+Takes the jobs song_dl_bot.py puts on the broker, downloads and uploads the
+audio straight to the requesting chat and acks the job. Run as many of these
+as you like, on any machine that reaches the broker and the database:
+
+    python worker.py --processes 4
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+
+from broker import create_broker
+from db_handler import init_db
+from deezer_handler import DeezerHandler
+import delivery
+from delivery import deliver_link
+from profiler import SamplingProfiler
+from utils import load_config
+
+logging.basicConfig(
+    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+)
+
+logger = logging.getLogger(__name__)
+
+
+def process_job(bot, deezer, job):
+    # deliver_link looks the link up in the music table first, so a job
+    # handed out twice is served from telegram_file_id the second time
+    # instead of being downloaded again.
+    deliver_link(bot, deezer, job["chat_id"], job["link"], job["user"])
+
+
+def profile_worker(profiler, seconds):
+    try:
+        path = profiler.profile_to_file(tempfile.gettempdir(), seconds)
+    except RuntimeError as e:
+        logger.warning("Worker %d: %s", os.getpid(), e)
+        return
+    logger.info("Worker %d profile written to %s", os.getpid(), path)
+
+
+def run_worker():
+    json_config = load_config()
+    # kill -USR1 <pid> writes a profile of the worker to the temp folder
+    profiler = SamplingProfiler()
+    if hasattr(signal, "SIGUSR1"):
+        seconds = json_config.get("PROFILE_SIGNAL_SECONDS", 30)
+        signal.signal(
+            signal.SIGUSR1,
+            lambda signum, frame: threading.Thread(
+                target=profile_worker, args=(profiler, seconds), daemon=True
+            ).start(),
+        )
+    init_db()
+    delivery.configure(json_config)
+    DeezerHandler.timeout = json_config.get("DEEZER_TIMEOUT", 10)
+    DeezerHandler.cache_size = json_config.get("DEEZER_CACHE_SIZE", 1024)
+    broker = create_broker(json_config)
+    bot = delivery.create_bot(json_config)
+    deezer = DeezerHandler()
+    max_attempts = json_config.get("BROKER_MAX_ATTEMPTS", 3)
+    logger.info("Worker %d waiting for jobs", os.getpid())
+    while True:
+        leased = broker.get()
+        if leased is None:
+            continue
+        job_id, job = leased
+        try:
+            process_job(bot, deezer, job)
+        except Exception as e:
+            logger.warning("Job %s for %s failed: %s", job_id, job["link"], e)
+            retry = broker.attempts(job_id) < max_attempts
+            broker.fail(job_id, e, retry)
+            if not retry:
+                bot.send_message(
+                    chat_id=job["chat_id"],
+                    text="Sorry, downloading this link failed.",
+                )
+        else:
+            broker.ack(job_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-p", "--processes", type=int, default=1, help="Number of worker processes"
+    )
+    args = parser.parse_args()
+    if args.processes == 1:
+        run_worker()
+        return
+    workers = [
+        multiprocessing.Process(target=run_worker) for _ in range(args.processes)
+    ]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()